@@ -1,12 +1,30 @@
 import streamlit as st
+from functools import partial
+from itertools import chain
 from io import BytesIO
 from typing import List, Optional, Dict
-from PIL import Image
-import base64
-import zipfile
-from diagram_utils import generate_diagram, DIAGRAM_SYSTEM_PROMPT
-from icon_utils import generate_icons, ICON_SYSTEM_PROMPT
 from auth import login_user, logout_user, is_authenticated, get_current_user
+from prompt_utils import DIAGRAM_SYSTEM_PROMPT, ICON_SYSTEM_PROMPT
+
+# Upper bound for the "Variants per prompt" control
+MAX_VARIANTS = 10
+
+# Number of images shown per gallery page
+GALLERY_PAGE_SIZE = 12
+
+# Width of the preview shown while editing (half the page)
+EDIT_PREVIEW_WIDTH = 1024
+
+# Seconds between refreshes of running jobs
+JOB_POLL_SECONDS = 1.0
+
+
+def gallery_file_name(entry) -> str:
+    """Download file name for a history entry."""
+    if entry.kind == "icon":
+        return f'icon_{entry.prompt}_{entry.id}.png'
+    return f'diagram_{entry.id}.png'
+
 
 # --- UI setup ---
 st.set_page_config(
@@ -31,6 +49,15 @@ if not is_authenticated():
                 st.error("Invalid username or password")
     st.stop()
 
+# Imaging, storage and job modules are only needed once signed in, so the login
+# page renders without loading Pillow, NumPy or the OpenAI SDK
+from image_utils import EncodedImage, PREVIEW_FORMAT, build_zip, read_archive
+from export_utils import ICON_LADDER, build_icon_export
+from history_utils import get_history_store
+from jobs_utils import get_job_queue, submit_diagram_job, submit_icon_job
+from memory_utils import SessionMemory
+from metrics_utils import get_metrics
+
 # Main app content (only shown if authenticated)
 st.title("📸 Image Card Generator")
 
@@ -41,18 +68,59 @@ with st.sidebar:
         logout_user()
         st.rerun()
 
-# Initialize session state for storing generated images and selected image
-if 'generated_images' not in st.session_state:
-    st.session_state.generated_images = {
-        "icons": {},  # Store icons by prompt
-        "diagrams": {}  # Store diagrams by prompt
-    }
-if 'selected_image' not in st.session_state:
-    st.session_state.selected_image = None
+    # Process-wide request metrics (all sessions on this server)
+    with st.expander("Performance"):
+        metrics = get_metrics()
+        stats = metrics.summary()
+        if not stats["calls"]:
+            st.caption("No image requests yet.")
+        else:
+            st.write(
+                f"Requests: {stats['calls']} ({stats['cache_hit_rate']:.0%} cached, "
+                f"{stats['coalesced']} shared, {stats['retries']} retries, {stats['errors']} errors)")
+            st.write(
+                f"API latency p50/p95/p99: {stats['api_latency_p50']:.1f}s / "
+                f"{stats['api_latency_p95']:.1f}s / {stats['api_latency_p99']:.1f}s")
+            st.write(
+                f"Queue wait p95: {stats['queue_wait_p95']:.1f}s, "
+                f"decode p95: {stats['decode_time_p95'] * 1000:.0f}ms")
+            st.write(f"Throughput: {stats['images_per_second']:.2f} images/s")
+            st.download_button(
+                label="Export (Prometheus)",
+                data=metrics.to_prometheus,
+                file_name="image_metrics.prom",
+                mime="text/plain",
+                key="export_metrics_prometheus"
+            )
+            st.download_button(
+                label="Export spans (JSONL)",
+                data=metrics.export_jsonl,
+                file_name="image_metrics.jsonl",
+                mime="application/x-ndjson",
+                key="export_metrics_jsonl"
+            )
+
+# Generated images are kept in the on-disk history store, not in session state
+history = get_history_store()
+username = get_current_user()
+
+# Generation runs on a server-wide background queue so the UI never blocks on the API
+job_queue = get_job_queue()
+
+# The selected image and the ZIP export live in a size-capped per-session store
+if 'memory' not in st.session_state:
+    st.session_state.memory = SessionMemory()
+memory = st.session_state.memory
+if 'zip_version' not in st.session_state:
+    st.session_state.zip_version = None
 if 'edit_mode' not in st.session_state:
     st.session_state.edit_mode = False
 if 'system_prompt' not in st.session_state:
     st.session_state.system_prompt = DIAGRAM_SYSTEM_PROMPT
+if 'job_ids' not in st.session_state:
+    st.session_state.job_ids = []
+if 'edit_job_id' not in st.session_state:
+    st.session_state.edit_job_id = None
 
 # Model selection
 model_type = st.selectbox(
@@ -86,13 +154,13 @@ with main_col1:
         prompt = st.text_area(
             "Enter your icon prompts (one per line):",
             height=120,
-            help="Enter multiple prompts, one per line. Each prompt will generate one image."
+            help="Enter multiple prompts, one per line. Each prompt generates 'Variants per prompt' images."
         )
     else:
         prompt = st.text_area(
             "Enter your diagram prompt:",
             height=120,
-            help="Enter a single prompt to generate one image."
+            help="Enter a single prompt; 'Variants per prompt' sets how many images are generated."
         )
 
     # Optional refs
@@ -107,138 +175,190 @@ with main_col1:
             data = file.read()
             refs.append(BytesIO(data))
 
+    variants = st.number_input(
+        "Variants per prompt",
+        min_value=1,
+        max_value=MAX_VARIANTS,
+        value=1,
+        help="Number of images to generate for each prompt (requested together in one API call)"
+    )
+
+    regenerate = st.checkbox(
+        "Regenerate (skip cache)",
+        help="Always call the API, even if an identical request was generated before"
+    )
+
+    postprocess = False
+    if model_type == "icon":
+        postprocess = st.checkbox(
+            "Clean up icons",
+            help="Make the background transparent, trim padding, normalise the card "
+                 "colour to #f9f1dd and fit every icon to the same size"
+        )
+
     # Generate button
     if st.button("Generate Images"):
         if not prompt.strip():
             st.error("Please enter a prompt to generate images.")
         else:
-            try:
-                with st.spinner("Generating image(s)..."):
-                    if model_type == "icon":
-                        prompts = [p.strip()
-                                   for p in prompt.split('\n') if p.strip()]
-                        cols = st.columns(2)
-                        # Append to previous images instead of overwriting
-                        if "icons" not in st.session_state.generated_images:
-                            st.session_state.generated_images["icons"] = {}
-                        for img, prompt_text in generate_icons(
-                            prompts=prompts,
-                            refs=refs if refs else None,
-                            system_prompt=st.session_state.system_prompt
-                        ):
-                            if prompt_text not in st.session_state.generated_images["icons"]:
-                                st.session_state.generated_images["icons"][prompt_text] = [
-                                ]
-                            st.session_state.generated_images["icons"][prompt_text].append(
-                                img)
-                            current_idx = len(
-                                st.session_state.generated_images["icons"][prompt_text]) - 1
-                            with cols[current_idx % 2]:
-                                st.image(img, use_container_width=True)
-                                buf = BytesIO()
-                                img.save(buf, format='PNG')
-                                st.download_button(
-                                    label='Download',
-                                    data=buf.getvalue(),
-                                    file_name=f'icon_{prompt_text}_{current_idx}.png',
-                                    mime='image/png',
-                                    key=f'download_{prompt_text}_{current_idx}'
-                                )
-                                if st.button("Edit This Image", key=f"edit_{prompt_text}_{current_idx}"):
-                                    st.session_state.selected_image = img
-                                    st.session_state.edit_mode = True
-                                    st.rerun()
-                    else:
-                        # Diagram generation
-                        img = generate_diagram(
-                            prompt=prompt,
-                            refs=refs if refs else None,
-                            system_prompt=st.session_state.system_prompt
-                        )
-                        if img:
-                            if "diagrams" not in st.session_state.generated_images:
-                                st.session_state.generated_images["diagrams"] = {
-                                }
-                            if prompt not in st.session_state.generated_images["diagrams"]:
-                                st.session_state.generated_images["diagrams"][prompt] = [
-                                ]
-                            st.session_state.generated_images["diagrams"][prompt].append(
-                                img)
-                            st.image(img, use_container_width=True)
-                            buf = BytesIO()
-                            img.save(buf, format='PNG')
-                            st.download_button(
-                                label='Download',
-                                data=buf.getvalue(),
-                                file_name=f'diagram_{len(st.session_state.generated_images["diagrams"][prompt])-1}.png',
-                                mime='image/png',
-                                key=f'download_diagram_{len(st.session_state.generated_images["diagrams"][prompt])-1}'
-                            )
-                            if st.button("Edit This Image", key=f"edit_diagram_{len(st.session_state.generated_images['diagrams'][prompt])-1}"):
-                                st.session_state.selected_image = img
-                                st.session_state.edit_mode = True
-                                st.rerun()
-            except Exception as e:
-                st.error(f"Error generating images: {e}")
+            ref_bytes = [ref.getvalue() for ref in refs] or None
+            if model_type == "icon":
+                prompts = [p.strip() for p in prompt.split('\n') if p.strip()]
+                # Pasted lists often overlap; generate_icons runs each distinct prompt once
+                duplicates = len(prompts) - len(set(prompts))
+                if duplicates:
+                    st.info(f"Skipped {duplicates} duplicate prompt(s).")
+                job_id = submit_icon_job(
+                    job_queue,
+                    username,
+                    prompts=prompts,
+                    refs=ref_bytes,
+                    system_prompt=st.session_state.system_prompt,
+                    use_cache=not regenerate,
+                    variants=int(variants),
+                    postprocess=postprocess
+                )
+            else:
+                job_id = submit_diagram_job(
+                    job_queue,
+                    username,
+                    prompt=prompt,
+                    refs=ref_bytes,
+                    system_prompt=st.session_state.system_prompt,
+                    use_cache=not regenerate,
+                    variants=int(variants)
+                )
+            st.session_state.job_ids.append(job_id)
 
-with main_col2:
-    # Display generated images if they exist
-    if st.session_state.generated_images:
-        st.subheader("Generated Images")
-        images_to_zip = []
-        if model_type == "icon":
-            for prompt_text, images in st.session_state.generated_images["icons"].items():
-                st.write(f"**Prompt: {prompt_text}**")
-                for idx, img in enumerate(images):
-                    st.image(img, use_container_width=True)
-                    buf = BytesIO()
-                    img.save(buf, format='PNG')
-                    st.download_button(
-                        label='Download',
-                        data=buf.getvalue(),
-                        file_name=f'icon_{prompt_text}_{idx+1}.png',
-                        mime='image/png',
-                        key=f'download_single_{prompt_text}_{idx}'
-                    )
-                    images_to_zip.append(
-                        (f'icon_{prompt_text}_{idx+1}.png', buf.getvalue()))
-        else:
-            for prompt_text, images in st.session_state.generated_images["diagrams"].items():
-                st.write(f"**Prompt: {prompt_text}**")
-                for idx, img in enumerate(images):
-                    st.image(img, use_container_width=True)
-                    buf = BytesIO()
-                    img.save(buf, format='PNG')
+    session_jobs = [job for job in map(job_queue.get, st.session_state.job_ids)
+                    if job is not None]
+
+    # Only poll while something is still running
+    @st.fragment(run_every=JOB_POLL_SECONDS if any(not job.finished for job in session_jobs) else None)
+    def show_jobs(was_running: bool):
+        jobs = [job for job in map(job_queue.get, st.session_state.job_ids)
+                if job is not None]
+        if was_running and all(job.finished for job in jobs):
+            # Rerun the whole page so the gallery picks up the new images
+            st.rerun()
+        for job in reversed(jobs):
+            done = len(job.results)
+            st.write(f"**{job.kind.title()}: {job.description}**")
+            st.progress(min(done / job.total, 1.0) if job.total else 1.0,
+                        text=f"{done}/{job.total} images ({job.status})")
+            if not job.finished:
+                if st.button("Cancel", key=f"cancel_{job.id}"):
+                    job.cancel()
+            for error in list(job.errors):
+                st.warning(f"Could not generate {error}")
+            cols = st.columns(2)
+            for current_idx, entry_id in enumerate(list(job.results)):
+                entry = history.get(entry_id)
+                with cols[current_idx % 2]:
+                    st.image(history.preview(entry), use_container_width=True)
                     st.download_button(
                         label='Download',
-                        data=buf.getvalue(),
-                        file_name=f'diagram_{idx+1}.png',
+                        data=partial(history.load, entry),
+                        file_name=gallery_file_name(entry),
                         mime='image/png',
-                        key=f'download_single_diagram_{idx}'
+                        key=f'download_{job.id}_{entry.id}'
                     )
-                    images_to_zip.append(
-                        (f'diagram_{idx+1}.png', buf.getvalue()))
-        # Show Download All (ZIP) if more than one image
-        if len(images_to_zip) > 1:
-            all_images_zip = BytesIO()
-            with zipfile.ZipFile(all_images_zip, 'w') as zipf:
-                for fname, data in images_to_zip:
-                    zipf.writestr(fname, data)
+                    if st.button("Edit This Image", key=f"edit_{job.id}_{entry.id}"):
+                        memory.put("selected_image", EncodedImage(history.load(entry)))
+                        st.session_state.edit_mode = True
+                        st.rerun()
+        if any(job.finished for job in jobs):
+            if st.button("Clear finished jobs", key="clear_jobs"):
+                st.session_state.job_ids = [job.id for job in jobs if not job.finished]
+                st.rerun()
+
+    if session_jobs:
+        show_jobs(any(not job.finished for job in session_jobs))
+
+with main_col2:
+    # Display the user's generated images, one page at a time
+    total_images = history.count(username, model_type)
+    if total_images:
+        st.subheader("Generated Images")
+        page_count = -(-total_images // GALLERY_PAGE_SIZE)
+        page = 1
+        if page_count > 1:
+            page = st.number_input(
+                f"Page (of {page_count})",
+                min_value=1,
+                max_value=page_count,
+                value=1,
+                key=f"gallery_page_{model_type}"
+            )
+        entries = history.page(
+            username,
+            model_type,
+            offset=(page - 1) * GALLERY_PAGE_SIZE,
+            limit=GALLERY_PAGE_SIZE
+        )
+        current_prompt = None
+        for entry in entries:
+            if entry.prompt != current_prompt:
+                st.write(f"**Prompt: {entry.prompt}**")
+                current_prompt = entry.prompt
+            st.image(history.preview(entry), use_container_width=True)
             st.download_button(
-                label="Download All (ZIP)",
-                data=all_images_zip.getvalue(),
-                file_name="all_images.zip",
-                mime="application/zip",
-                key="download_all_zip"
+                label='Download',
+                # Full-size bytes are only read from disk when the button is clicked
+                data=partial(history.load, entry),
+                file_name=gallery_file_name(entry),
+                mime='image/png',
+                key=f'download_single_{entry.id}'
             )
+        # Show Download All (ZIP) if more than one image
+        if total_images > 1:
+            include_ladder = False
+            if model_type == "icon":
+                include_ladder = st.checkbox(
+                    "Include size ladder and sprite sheets",
+                    help=f"Adds every icon at {', '.join(map(str, ICON_LADDER))}px plus "
+                         "sprite sheets with a JSON coordinate index",
+                    key="zip_include_ladder"
+                )
+            # The archive is only built on request and reused until the history changes
+            zip_version = (model_type, history.latest_id(username, model_type), include_ladder)
+            if st.session_state.zip_version != zip_version:
+                if st.button("Prepare ZIP", key="prepare_zip"):
+                    all_entries = history.page(username, model_type, limit=-1)
+                    # Images are read from disk one at a time while the archive is written
+                    files = ((gallery_file_name(entry), history.load(entry)) for entry in all_entries)
+                    if include_ladder:
+                        files = chain(files, build_icon_export([
+                            (gallery_file_name(entry)[:-len(".png")], partial(history.load, entry))
+                            for entry in all_entries
+                        ]))
+                    memory.put("zip", build_zip(
+                        files,
+                        manifest=[
+                            {"file": gallery_file_name(entry), "prompt": entry.prompt,
+                             "kind": entry.kind, "created_at": entry.created_at}
+                            for entry in all_entries
+                        ]
+                    ))
+                    st.session_state.zip_version = zip_version
+            if st.session_state.zip_version == zip_version:
+                st.download_button(
+                    label="Download All (ZIP)",
+                    data=partial(read_archive, memory.get("zip")),
+                    file_name="all_images.zip",
+                    mime="application/zip",
+                    key="download_all_zip"
+                )
 
 # Edit mode section
-if st.session_state.edit_mode and st.session_state.selected_image is not None:
+selected_image = memory.get("selected_image")
+if st.session_state.edit_mode and selected_image is not None:
     st.subheader("Edit Image")
     edit_col1, edit_col2 = st.columns(2)
 
     with edit_col1:
-        st.image(st.session_state.selected_image, use_container_width=True)
+        st.image(selected_image.thumbnail(EDIT_PREVIEW_WIDTH, PREVIEW_FORMAT),
+                 use_container_width=True)
 
         # Add option to upload a new image for editing
         uploaded_image = st.file_uploader(
@@ -248,43 +368,67 @@ if st.session_state.edit_mode and st.session_state.selected_image is not None:
         )
 
         if uploaded_image:
-            st.session_state.selected_image = Image.open(uploaded_image)
+            memory.put("selected_image", EncodedImage(uploaded_image.read()))
             st.rerun()
 
     with edit_col2:
         edit_prompt = st.text_area("Enter edit prompt:", height=100)
-        if st.button("Apply Edit"):
-            with st.spinner("Editing image..."):
-                try:
-                    # Convert PIL Image to BytesIO for editing
-                    img_byte_arr = BytesIO()
-                    st.session_state.selected_image.save(
-                        img_byte_arr, format='PNG')
-                    img_byte_arr.seek(0)
-
-                    # Generate edited image using appropriate generator
-                    if model_type == "icon":
-                        edited_imgs = list(generate_icons(
-                            prompts=edit_prompt,
-                            refs=[img_byte_arr],
-                            system_prompt=st.session_state.system_prompt
-                        ))
-                        if edited_imgs:
-                            # Get first image from generator
-                            st.session_state.selected_image = edited_imgs[0][0]
-                    else:
-                        edited_img = generate_diagram(
-                            prompt=edit_prompt,
-                            refs=[img_byte_arr],
-                            system_prompt=st.session_state.system_prompt
-                        )
-                        if edited_img:
-                            st.session_state.selected_image = edited_img
-                    st.rerun()
-                except Exception as e:
-                    st.error(f"Error editing image: {e}")
+        edit_job = None
+        if st.session_state.edit_job_id is not None:
+            edit_job = job_queue.get(st.session_state.edit_job_id)
+
+        if edit_job is None:
+            if st.button("Apply Edit"):
+                # The selected image is the reference for a regular generation job
+                if model_type == "icon":
+                    st.session_state.edit_job_id = submit_icon_job(
+                        job_queue,
+                        username,
+                        prompts=[edit_prompt],
+                        refs=[selected_image.data],
+                        system_prompt=st.session_state.system_prompt
+                    )
+                else:
+                    st.session_state.edit_job_id = submit_diagram_job(
+                        job_queue,
+                        username,
+                        prompt=edit_prompt,
+                        refs=[selected_image.data],
+                        system_prompt=st.session_state.system_prompt
+                    )
+                st.rerun()
+        else:
+            @st.fragment(run_every=None if edit_job.finished else JOB_POLL_SECONDS)
+            def show_edit_job():
+                job = job_queue.get(st.session_state.edit_job_id)
+                if job is None or not job.finished:
+                    st.info("Editing image...")
+                    if job is not None and st.button("Cancel Edit", key="cancel_edit"):
+                        job.cancel()
+                    return
+                st.session_state.edit_job_id = None
+                if job.results:
+                    entry = history.get(job.results[0])
+                    memory.put("selected_image", EncodedImage(history.load(entry)))
+                elif job.status != "cancelled":
+                    st.session_state.edit_error = "; ".join(job.errors) or "no image returned"
+                st.rerun()
+
+            show_edit_job()
+
+        if st.session_state.get("edit_error"):
+            st.error(f"Error editing image: {st.session_state.pop('edit_error')}")
 
         if st.button("Back to Gallery"):
             st.session_state.edit_mode = False
-            st.session_state.selected_image = None
+            memory.pop("selected_image")
             st.rerun()
+
+# Keep this session within its memory budget and show where it stands
+memory.enforce()
+with st.sidebar:
+    usage = memory.usage()
+    st.progress(
+        min(usage / memory.budget, 1.0),
+        text=f"Session memory: {usage / (1024 * 1024):.1f} / {memory.budget / (1024 * 1024):.0f} MB"
+    )
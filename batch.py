@@ -0,0 +1,225 @@
+"""
+Headless batch runner for bulk icon and diagram generation.
+
+Reads prompts from a CSV or JSONL file and writes every generated PNG into an
+output directory, without Streamlit. Each input row may have the columns/keys:
+
+    prompt    (required) the user prompt
+    kind      "icon" or "diagram" (defaults to --kind)
+    id        stable job identifier (defaults to the row number)
+    size      image size (defaults to --size)
+    variants  number of images for the prompt (defaults to --variants)
+
+Completed jobs are appended to `checkpoint.jsonl` in the output directory, so
+re-running the same command after a crash only processes what is left.
+
+Usage:
+    python batch.py prompts.csv --out output/ --concurrency 8
+"""
+import os
+import re
+import csv
+import sys
+import json
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Dict, List, Optional, Set
+
+from cache_utils import write_file_atomic
+from diagram_utils import generate_diagrams
+from icon_utils import generate_icons
+from prompt_utils import DIAGRAM_SYSTEM_PROMPT, ICON_SYSTEM_PROMPT
+
+CHECKPOINT_FILE = "checkpoint.jsonl"
+FAILURES_FILE = "failures.jsonl"
+
+
+def load_jobs(
+    path: str,
+    default_kind: str,
+    default_size: str,
+    default_variants: int = 1
+) -> List[Dict[str, Any]]:
+    """
+    Read batch jobs from a CSV or JSONL file.
+
+    Args:
+        path: Input file; `.jsonl`/`.ndjson` is parsed as JSON lines, anything else as CSV
+        default_kind: Generator used for rows without a `kind`
+        default_size: Image size used for rows without a `size`
+        default_variants: Images per prompt for rows without `variants`
+    """
+    with open(path, newline="", encoding="utf-8") as f:
+        if path.endswith((".jsonl", ".ndjson")):
+            rows = [json.loads(line) for line in f if line.strip()]
+        else:
+            rows = list(csv.DictReader(f))
+
+    jobs = []
+    for line_no, row in enumerate(rows, start=1):
+        prompt = (row.get("prompt") or "").strip()
+        if not prompt:
+            continue
+        kind = (row.get("kind") or default_kind).strip()
+        if kind not in ("icon", "diagram"):
+            raise ValueError(f"Row {line_no}: unknown kind {kind!r}")
+        jobs.append({
+            "id": str(row.get("id") or f"row-{line_no}"),
+            "kind": kind,
+            "prompt": prompt,
+            "size": (row.get("size") or default_size).strip(),
+            "variants": int(row.get("variants") or default_variants),
+        })
+    return jobs
+
+
+def load_checkpoint(out_dir: str) -> Set[str]:
+    """Return the ids of jobs already completed in `out_dir`."""
+    path = os.path.join(out_dir, CHECKPOINT_FILE)
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                done.add(json.loads(line)["id"])
+            except (ValueError, KeyError):
+                # A crash can leave a truncated last line; that job simply reruns
+                continue
+    return done
+
+
+def _safe_name(text: str) -> str:
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", text).strip("_")[:80] or "image"
+
+
+def run_job(
+    job: Dict[str, Any],
+    out_dir: str,
+    system_prompts: Dict[str, Optional[str]],
+    use_cache: bool
+) -> List[str]:
+    """
+    Generate the image(s) for one job and write them to `out_dir`.
+
+    Returns:
+        The file names written
+    """
+    if job["kind"] == "icon":
+        images = [img for img, _ in generate_icons(
+            prompts=job["prompt"],
+            size=job["size"],
+            system_prompt=system_prompts["icon"],
+            max_concurrency=1,
+            use_cache=use_cache,
+            variants=job["variants"]
+        )]
+    else:
+        images = list(generate_diagrams(
+            prompt=job["prompt"],
+            size=job["size"],
+            system_prompt=system_prompts["diagram"],
+            use_cache=use_cache,
+            variants=job["variants"]
+        ))
+
+    files = []
+    for idx, img in enumerate(images):
+        fname = f"{_safe_name(job['id'])}_{job['kind']}_{idx + 1}.png"
+        # Written atomically so a crash never leaves a half-written PNG behind
+        write_file_atomic(os.path.join(out_dir, fname), img.data)
+        files.append(fname)
+    return files
+
+
+def run_batch(
+    jobs: List[Dict[str, Any]],
+    out_dir: str,
+    concurrency: int = 4,
+    system_prompts: Optional[Dict[str, Optional[str]]] = None,
+    use_cache: bool = True
+) -> int:
+    """
+    Run every job not yet in the checkpoint, streaming results to `out_dir`.
+
+    Args:
+        jobs: Jobs from `load_jobs`
+        out_dir: Output directory (also holds the checkpoint)
+        concurrency: Number of jobs in flight at once
+        system_prompts: Optional system prompt override per kind
+        use_cache: Serve previously generated images for identical inputs
+
+    Returns:
+        The number of jobs that failed
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    system_prompts = system_prompts or {"icon": None, "diagram": None}
+    done = load_checkpoint(out_dir)
+    pending = [job for job in jobs if job["id"] not in done]
+    print(f"{len(jobs)} jobs, {len(jobs) - len(pending)} already done, {len(pending)} to run")
+
+    write_lock = threading.Lock()
+    failures = 0
+    with open(os.path.join(out_dir, CHECKPOINT_FILE), "a", encoding="utf-8") as checkpoint, \
+            open(os.path.join(out_dir, FAILURES_FILE), "a", encoding="utf-8") as failure_log, \
+            ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        futures = {
+            executor.submit(run_job, job, out_dir, system_prompts, use_cache): job
+            for job in pending
+        }
+        for count, future in enumerate(as_completed(futures), start=1):
+            job = futures[future]
+            try:
+                files = future.result()
+            except Exception as e:
+                failures += 1
+                with write_lock:
+                    failure_log.write(json.dumps({**job, "error": str(e)}) + "\n")
+                    failure_log.flush()
+                print(f"[{count}/{len(pending)}] FAILED {job['id']}: {e}", file=sys.stderr)
+                continue
+            with write_lock:
+                checkpoint.write(json.dumps({**job, "files": files}) + "\n")
+                checkpoint.flush()
+                os.fsync(checkpoint.fileno())
+            print(f"[{count}/{len(pending)}] {job['id']}: {', '.join(files) or 'no image returned'}")
+    return failures
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Generate icons and diagrams in bulk from a CSV/JSONL file of prompts.")
+    parser.add_argument("input", help="CSV or JSONL file with a 'prompt' column/key")
+    parser.add_argument("--out", default="batch_output", help="Output directory")
+    parser.add_argument("--kind", choices=["icon", "diagram"], default="icon",
+                        help="Generator for rows without a 'kind'")
+    parser.add_argument("--size", default="auto", help="Image size for rows without a 'size'")
+    parser.add_argument("--variants", type=int, default=1,
+                        help="Images per prompt for rows without 'variants'")
+    parser.add_argument("--concurrency", type=int, default=4, help="Jobs in flight at once")
+    parser.add_argument("--icon-system-prompt", help="File with a custom icon system prompt")
+    parser.add_argument("--diagram-system-prompt", help="File with a custom diagram system prompt")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Always call the API, even for previously generated inputs")
+    args = parser.parse_args(argv)
+
+    system_prompts = {"icon": ICON_SYSTEM_PROMPT, "diagram": DIAGRAM_SYSTEM_PROMPT}
+    for kind, path in (("icon", args.icon_system_prompt), ("diagram", args.diagram_system_prompt)):
+        if path:
+            with open(path, encoding="utf-8") as f:
+                system_prompts[kind] = f.read()
+
+    jobs = load_jobs(args.input, args.kind, args.size, args.variants)
+    failures = run_batch(
+        jobs,
+        args.out,
+        concurrency=args.concurrency,
+        system_prompts=system_prompts,
+        use_cache=not args.no_cache
+    )
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
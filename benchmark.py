@@ -0,0 +1,433 @@
+"""
+Reproducible benchmarks for the generation pipeline against a local mock API.
+
+Starts an in-process HTTP server that imitates the OpenAI images endpoints
+(with configurable latency, payload size and injected 429/5xx errors),
+points the shared client at it
+and measures throughput, latency percentiles and peak Python heap memory
+(tracemalloc; native Pillow buffers are not included) for:
+
+    icons    generate_icons over N prompts
+    diagram  generate_diagrams with N variants
+    refs     prepare_refs over N phone-sized reference photos
+    gallery  storing N images in the history store, rendering one gallery page
+             of previews and building the Download All ZIP
+    startup  rendering the login page N times, each in a fresh interpreter
+
+Results are written as JSON. Passing --baseline compares against an earlier
+run and exits non-zero if any scenario regressed beyond --tolerance. The
+startup scenario also fails the run if the login page takes longer than
+--startup-budget (p95) or imports any of startup_utils.DEFERRED_MODULES.
+
+Usage:
+    python benchmark.py --sizes 1,10,100,1000 --out bench.json
+    python benchmark.py --baseline bench.json --out bench_new.json
+    python benchmark.py --scenarios icons --error-rate 0.2 --retry-after 0.5
+"""
+import os
+import re
+import sys
+import json
+import time
+import base64
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import tracemalloc
+from io import BytesIO
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from PIL import Image
+
+# The mock server ignores the key, but the client refuses to start without one
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+
+import cache_utils
+import client_utils
+import history_utils
+import scheduler_utils
+from diagram_utils import generate_diagrams
+from icon_utils import generate_icons
+from image_utils import build_zip, prepare_refs
+from metrics_utils import percentile
+from startup_utils import probe_startup
+
+SCENARIOS = ("icons", "diagram", "refs", "gallery", "startup")
+
+# Metrics compared against a baseline, and whether bigger is better
+COMPARED_METRICS = {
+    "throughput": True,
+    "latency_p95": False,
+    "peak_memory_mb": False,
+}
+
+
+def make_png(size: str, seed: int = 0) -> bytes:
+    """Noise PNG of `size` ("WxH"); noise keeps it from compressing unrealistically well."""
+    width, height = (int(v) for v in size.split("x"))
+    rng = random.Random(seed)
+    img = Image.frombytes("RGB", (width, height), rng.randbytes(width * height * 3))
+    buf = BytesIO()
+    img.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+class MockImagesServer:
+    """
+    Local stand-in for the `/v1/images/generations` and `/v1/images/edits`
+    endpoints returning `n` copies of a fixed base64 PNG after `latency`
+    (+/- `jitter`) seconds.
+
+    Errors can be injected to exercise the scheduler: `error_rate` answers
+    that share of requests with `error_status`, and `scripted_errors` maps a
+    prompt substring to the (status, Retry-After seconds) responses its
+    requests get, in order, before they succeed. `attempts` counts the
+    requests seen for each scripted substring.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.2,
+        jitter: float = 0.0,
+        payload_size: str = "1024x1024",
+        seed: int = 0,
+        error_rate: float = 0.0,
+        error_status: int = 429,
+        retry_after: Optional[float] = None,
+        scripted_errors: Optional[Dict[str, Sequence[Tuple[int, Optional[float]]]]] = None
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.rng = random.Random(seed)
+        self.b64_payload = base64.b64encode(make_png(payload_size)).decode()
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.scripted_errors = {key: list(responses) for key, responses in (scripted_errors or {}).items()}
+        self.attempts: Dict[str, int] = {key: 0 for key in self.scripted_errors}
+        self.requests = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/v1"
+
+    def _error_for(self, prompt: str) -> Optional[Tuple[int, Optional[float]]]:
+        """Pick the error response for a request, if any (caller holds the lock)."""
+        for key, responses in self.scripted_errors.items():
+            if key in prompt:
+                self.attempts[key] += 1
+                return responses.pop(0) if responses else None
+        if self.error_rate and self.rng.random() < self.error_rate:
+            return self.error_status, self.retry_after
+        return None
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if self.path.endswith("/images/generations"):
+                    fields = json.loads(body)
+                    n = fields.get("n") or 1
+                    prompt = fields.get("prompt") or ""
+                else:
+                    # Edits are multipart; pull the n and prompt fields out of the form data
+                    match = re.search(rb'name="n"\r\n\r\n(\d+)', body)
+                    n = int(match.group(1)) if match else 1
+                    match = re.search(rb'name="prompt"\r\n\r\n(.*?)\r\n--', body, re.DOTALL)
+                    prompt = match.group(1).decode() if match else ""
+                with server._lock:
+                    server.requests += 1
+                    delay = server.latency + server.rng.uniform(-server.jitter, server.jitter)
+                    error = server._error_for(prompt)
+                    if error is not None:
+                        server.errors += 1
+                time.sleep(max(0.0, delay))
+                if error is not None:
+                    status, retry_after = error
+                    payload = json.dumps({"error": {
+                        "message": f"mock error {status}", "type": "mock_error", "code": status,
+                    }}).encode()
+                    self.send_response(status)
+                    if retry_after is not None:
+                        self.send_header("Retry-After", f"{retry_after:g}")
+                else:
+                    payload = json.dumps({
+                        "created": int(time.time()),
+                        "data": [{"b64_json": server.b64_payload} for _ in range(n)],
+                    }).encode()
+                    self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def __enter__(self) -> "MockImagesServer":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def measure(run: Callable[[], List[float]]) -> Dict[str, float]:
+    """
+    Run a scenario under tracemalloc.
+
+    Args:
+        run: Callable returning per-item completion times (seconds since start)
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        completions = run()
+        wall = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        "items": len(completions),
+        "wall_s": wall,
+        "throughput": len(completions) / wall if wall > 0 else 0.0,
+        "latency_p50": percentile(completions, 50),
+        "latency_p95": percentile(completions, 95),
+        "latency_p99": percentile(completions, 99),
+        "peak_memory_mb": peak / (1024 * 1024),
+    }
+
+
+def bench_icons(batch_size: int, args: argparse.Namespace) -> Dict[str, float]:
+    def run() -> List[float]:
+        start = time.perf_counter()
+        completions = []
+        for _ in generate_icons(
+            prompts=[f"icon {i}" for i in range(batch_size)],
+            max_concurrency=args.concurrency,
+            use_cache=False
+        ):
+            completions.append(time.perf_counter() - start)
+        return completions
+    return measure(run)
+
+
+def bench_diagram(batch_size: int, args: argparse.Namespace) -> Dict[str, float]:
+    def run() -> List[float]:
+        start = time.perf_counter()
+        completions = []
+        for _ in generate_diagrams(prompt="benchmark diagram", use_cache=False, variants=batch_size):
+            completions.append(time.perf_counter() - start)
+        return completions
+    return measure(run)
+
+
+def bench_refs(batch_size: int, args: argparse.Namespace) -> Dict[str, float]:
+    # Distinct phone-sized JPEGs so deduplication doesn't skip the work
+    photos = []
+    for i in range(batch_size):
+        buf = BytesIO()
+        Image.new("RGB", (4032, 3024), (i % 256, (i * 7) % 256, (i * 13) % 256)).save(buf, format="JPEG")
+        photos.append(buf.getvalue())
+
+    def run() -> List[float]:
+        start = time.perf_counter()
+        completions = []
+        for photo in photos:
+            prepare_refs([photo])
+            completions.append(time.perf_counter() - start)
+        return completions
+    return measure(run)
+
+
+def bench_gallery(batch_size: int, args: argparse.Namespace) -> Dict[str, float]:
+    images = [make_png(args.payload_size, seed=i) for i in range(min(batch_size, 16))]
+    directory = tempfile.mkdtemp(prefix="bench_history_")
+    try:
+        store = history_utils.HistoryStore(directory)
+
+        def run() -> List[float]:
+            start = time.perf_counter()
+            completions = []
+            for i in range(batch_size):
+                store.add("bench", "icon", f"icon {i}", images[i % len(images)])
+                completions.append(time.perf_counter() - start)
+            # One gallery page of previews, then the full ZIP export
+            for entry in store.page("bench", "icon", limit=12):
+                store.preview(entry)
+            build_zip((f"{entry.id}.png", store.load(entry))
+                      for entry in store.page("bench", "icon", limit=-1)).close()
+            completions.append(time.perf_counter() - start)
+            return completions
+        return measure(run)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def bench_startup(batch_size: int, args: argparse.Namespace) -> Dict[str, Any]:
+    loaded = set()
+
+    def run() -> List[float]:
+        # Latencies here are per-run cold start times, not completion offsets
+        durations = []
+        for _ in range(batch_size):
+            probe = probe_startup()
+            if probe["errors"]:
+                raise RuntimeError(f"login page failed: {probe['errors']}")
+            loaded.update(probe["loaded"])
+            durations.append(probe["seconds"])
+        return durations
+    return {**measure(run), "deferred_loaded": sorted(loaded)}
+
+
+BENCHMARKS: Dict[str, Callable[[int, argparse.Namespace], Dict[str, Any]]] = {
+    "icons": bench_icons,
+    "diagram": bench_diagram,
+    "refs": bench_refs,
+    "gallery": bench_gallery,
+    "startup": bench_startup,
+}
+
+
+def compare(results: List[Dict[str, Any]], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """
+    List regressions of `results` against a baseline run.
+
+    Args:
+        results: Results of the current run
+        baseline: Parsed JSON of an earlier run
+        tolerance: Allowed relative slowdown, e.g. 0.15 for 15%
+    """
+    previous = {(r["scenario"], r["batch_size"]): r for r in baseline.get("results", [])}
+    regressions = []
+    for result in results:
+        old = previous.get((result["scenario"], result["batch_size"]))
+        if old is None:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            before, after = old.get(metric), result.get(metric)
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            if (higher_is_better and change < -tolerance) or (not higher_is_better and change > tolerance):
+                regressions.append(
+                    f"{result['scenario']}[{result['batch_size']}] {metric}: {before:.4g} -> {after:.4g} ({change:+.0%})")
+    return regressions
+
+
+def check_startup(results: List[Dict[str, Any]], budget: float) -> List[str]:
+    """
+    List startup results over the cold-start budget or importing deferred modules.
+
+    Args:
+        results: Results of the current run
+        budget: Allowed p95 login page render time in seconds
+    """
+    violations = []
+    for result in results:
+        if result["scenario"] != "startup":
+            continue
+        if result["latency_p95"] > budget:
+            violations.append(
+                f"startup[{result['batch_size']}] latency_p95: {result['latency_p95']:.3f}s > budget {budget:.3f}s")
+        if result["deferred_loaded"]:
+            violations.append(
+                f"startup[{result['batch_size']}] login page imported {', '.join(result['deferred_loaded'])}")
+    return violations
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the image pipeline against a local mock API.")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help=f"Comma-separated subset of {', '.join(SCENARIOS)}")
+    parser.add_argument("--sizes", default="1,10,100", help="Comma-separated batch sizes")
+    parser.add_argument("--latency", type=float, default=0.2, help="Mock API latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Random +/- latency jitter in seconds")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the mock latency jitter")
+    parser.add_argument("--payload-size", default="1024x1024", help="Mock image size WxH")
+    parser.add_argument("--concurrency", type=int, default=8, help="max_concurrency for icon batches")
+    parser.add_argument("--rpm", type=float, default=1_000_000, help="Scheduler requests-per-minute limit")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="Share of mock API requests answered with --error-status")
+    parser.add_argument("--error-status", type=int, default=429, help="HTTP status of injected errors")
+    parser.add_argument("--retry-after", type=float, help="Retry-After seconds sent with injected errors")
+    parser.add_argument("--out", default="benchmark_results.json", help="Where to write the JSON results")
+    parser.add_argument("--baseline", help="Earlier results JSON to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="Allowed relative regression")
+    parser.add_argument("--startup-budget", type=float, default=2.0,
+                        help="Allowed p95 login page cold start in seconds")
+    args = parser.parse_args(argv)
+
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = set(scenarios) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+
+    cache_dir = tempfile.mkdtemp(prefix="bench_cache_")
+    results = []
+    try:
+        with MockImagesServer(
+            args.latency, args.jitter, args.payload_size, args.seed,
+            error_rate=args.error_rate, error_status=args.error_status, retry_after=args.retry_after
+        ) as server:
+            # Isolate the run: fresh cache, no client-side throttling, pool sized for the run
+            cache_utils._cache = cache_utils.ImageCache(cache_dir)
+            scheduler_utils._scheduler = scheduler_utils.RequestScheduler(requests_per_minute=args.rpm)
+            client_utils.set_client(client_utils.create_client(
+                pool_size=max(args.concurrency, client_utils.DEFAULT_POOL_SIZE),
+                base_url=server.base_url
+            ))
+            # Warm up lazy SDK imports and the connection pool outside the measurements
+            list(generate_icons(prompts="warmup", use_cache=False))
+            for scenario in scenarios:
+                for batch_size in sizes:
+                    result = {"scenario": scenario, "batch_size": batch_size,
+                              **BENCHMARKS[scenario](batch_size, args)}
+                    results.append(result)
+                    print(f"{scenario:8} n={batch_size:<5} {result['throughput']:9.2f} items/s  "
+                          f"p50 {result['latency_p50']:.3f}s  p95 {result['latency_p95']:.3f}s  "
+                          f"peak {result['peak_memory_mb']:.1f} MB")
+    finally:
+        client_utils.set_client(None)
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    report = {
+        "created_at": time.time(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("out", "baseline")},
+        "results": results,
+    }
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.out}")
+
+    regressions = check_startup(results, args.startup_budget)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions += compare(results, json.load(f), args.tolerance)
+    for line in regressions:
+        print(f"REGRESSION {line}", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,150 @@
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+from typing import Optional, List, Tuple
+
+# Default location and limits for the on-disk result cache (overridable via environment)
+DEFAULT_CACHE_DIR = os.environ.get("IMAGE_CACHE_DIR", ".image_cache")
+DEFAULT_CACHE_MAX_BYTES = int(os.environ.get(
+    "IMAGE_CACHE_MAX_BYTES", str(500 * 1024 * 1024)))
+DEFAULT_CACHE_TTL = float(os.environ["IMAGE_CACHE_TTL"]) if os.environ.get(
+    "IMAGE_CACHE_TTL") else None
+
+
+def make_cache_key(**inputs) -> str:
+    """
+    Build a content-addressed key from every input that affects the generated image.
+
+    Args:
+        inputs: JSON-serialisable generation inputs (prompts, size, reference hashes, ...)
+    """
+    payload = json.dumps(inputs, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def hash_bytes(data: bytes) -> str:
+    """Return the hex SHA-256 digest of raw bytes (used for reference images)."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def write_file_atomic(path: str, data: bytes) -> None:
+    """
+    Write `data` to `path` via a temp file and rename, so readers never see a
+    partial file and a failed write leaves nothing behind.
+
+    Args:
+        path: Destination file; its directory is created if missing
+        data: File contents
+    """
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class ImageCache:
+    """
+    Persistent content-addressed store of generated PNG bytes.
+
+    Entries are files named by their key. The file mtime records when the entry
+    was written (for the TTL) and the atime records the last hit (for LRU eviction
+    once the store grows past `max_bytes`).
+    """
+
+    def __init__(
+        self,
+        directory: str = DEFAULT_CACHE_DIR,
+        max_bytes: int = DEFAULT_CACHE_MAX_BYTES,
+        ttl: Optional[float] = DEFAULT_CACHE_TTL
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        # Shard by key prefix so a large cache doesn't end up in one huge directory
+        return os.path.join(self.directory, key[:2], f"{key}.png")
+
+    def get(self, key: str) -> Optional[bytes]:
+        """Return the cached bytes for `key`, or None on a miss or expired entry."""
+        path = self._path(key)
+        try:
+            stat = os.stat(path)
+            if self.ttl is not None and time.time() - stat.st_mtime > self.ttl:
+                os.remove(path)
+                return None
+            with open(path, "rb") as f:
+                data = f.read()
+            # Record the hit for LRU ordering without touching the write time
+            os.utime(path, (time.time(), stat.st_mtime))
+            return data
+        except FileNotFoundError:
+            return None
+
+    def set(self, key: str, data: bytes) -> None:
+        """Store `data` under `key` and evict old entries if over budget."""
+        write_file_atomic(self._path(key), data)
+        self._evict()
+
+    def clear(self) -> None:
+        """Remove every cached entry."""
+        for path, _, _ in self._entries():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _entries(self) -> List[Tuple[str, int, float]]:
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith(".png"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((path, stat.st_size, stat.st_atime))
+        return entries
+
+    def _evict(self) -> None:
+        with self._lock:
+            entries = self._entries()
+            total = sum(size for _, size, _ in entries)
+            if total <= self.max_bytes:
+                return
+            # Least recently used first
+            for path, size, _ in sorted(entries, key=lambda e: e[2]):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                if total <= self.max_bytes:
+                    break
+
+
+_cache: Optional[ImageCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> ImageCache:
+    """Return the process-wide image cache, creating it on first use."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ImageCache()
+        return _cache
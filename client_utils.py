@@ -0,0 +1,71 @@
+import os
+import threading
+from typing import Any, Optional
+import httpx
+from openai import OpenAI, DefaultHttpxClient
+from config_utils import get_api_key
+
+# Connection pool and timeout settings for the shared client (overridable via environment)
+DEFAULT_POOL_SIZE = int(os.environ.get("IMAGE_API_POOL_SIZE", "16"))
+DEFAULT_TIMEOUT = float(os.environ.get("IMAGE_API_TIMEOUT", "300"))
+DEFAULT_CONNECT_TIMEOUT = float(os.environ.get("IMAGE_API_CONNECT_TIMEOUT", "10"))
+DEFAULT_KEEPALIVE_EXPIRY = float(os.environ.get("IMAGE_API_KEEPALIVE", "120"))
+
+
+def create_client(
+    pool_size: int = DEFAULT_POOL_SIZE,
+    timeout: float = DEFAULT_TIMEOUT,
+    connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+    keepalive_expiry: float = DEFAULT_KEEPALIVE_EXPIRY,
+    base_url: Optional[str] = None
+) -> OpenAI:
+    """
+    Build an OpenAI client on a keep-alive HTTP connection pool.
+
+    Args:
+        pool_size: Maximum (and kept-alive) connections; should cover the
+            number of requests generators keep in flight
+        timeout: Read/write timeout in seconds (image generation is slow)
+        connect_timeout: Connection timeout in seconds
+        keepalive_expiry: Seconds an idle connection is kept open for reuse
+        base_url: Optional API base URL, e.g. a local mock server
+            (defaults to OPENAI_BASE_URL or the public API)
+    """
+    http_client = DefaultHttpxClient(
+        limits=httpx.Limits(
+            max_connections=pool_size,
+            max_keepalive_connections=pool_size,
+            keepalive_expiry=keepalive_expiry
+        ),
+        timeout=httpx.Timeout(timeout, connect=connect_timeout)
+    )
+    # Retries are handled by the shared scheduler, so the SDK's own retries are off
+    return OpenAI(
+        api_key=get_api_key(),
+        base_url=base_url,
+        max_retries=0,
+        http_client=http_client
+    )
+
+
+_client: Optional[Any] = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> OpenAI:
+    """Return the process-wide OpenAI client, creating it on first use."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = create_client()
+        return _client
+
+
+def set_client(client: Optional[Any]) -> None:
+    """
+    Replace the shared client, e.g. with a stub exposing `images.generate` and
+    `images.edit`. Passing None makes the next `get_client()` build a fresh one.
+    """
+    global _client
+    with _client_lock:
+        _client = client
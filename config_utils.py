@@ -0,0 +1,29 @@
+import os
+import sys
+from dotenv import load_dotenv
+
+# Pick up OPENAI_API_KEY from a local .env when running outside Streamlit
+load_dotenv()
+
+
+def get_api_key() -> str:
+    """
+    Resolve the OpenAI API key without requiring Streamlit.
+
+    Inside the Streamlit app the key comes from `st.secrets["openai"]["api_key"]`
+    as before; everywhere else (CLI, scripts, tests) it is read from the
+    OPENAI_API_KEY environment variable or `.env` file.
+    """
+    # Only consult Streamlit secrets if the app already imported Streamlit
+    if "streamlit" in sys.modules:
+        import streamlit as st
+        try:
+            return st.secrets["openai"]["api_key"]
+        except (KeyError, FileNotFoundError):
+            pass
+
+    api_key = os.environ.get("OPENAI_API_KEY")
+    if not api_key:
+        raise RuntimeError(
+            "OpenAI API key not found: set OPENAI_API_KEY or add [openai] api_key to Streamlit secrets")
+    return api_key
@@ -1,91 +1,199 @@
 import os
-import base64
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from io import BytesIO
 from typing import List, Optional, Literal, Generator
-import streamlit as st
-from openai import OpenAI
-from PIL import Image
-
-# Initialize OpenAI client with API key from secrets
-client = OpenAI(api_key=st.secrets["openai"]["api_key"])
-
-# System prompt for diagram generation
-DIAGRAM_SYSTEM_PROMPT = """You are an expert visual communicator and designer. Your task is to create advanced, yet easy-to-understand, hand-drawn style diagrams for business, marketing, and organizational workflows. Your diagrams should:
-
-Use a minimalist, illustrated hand-drawn aesthetic, similar to visual note-taking or whiteboard sketching.
-Include clearly labeled characters (e.g., Product Manager, Strategist) with simple illustrated avatars.
-Keep padding around the image and no information should get cut off
-Depict communication tools and challenges using icons (e.g., email, meetings, Slack, confusion emoji, clock, warning signs).
-Use dotted arrows to indicate communication or information flow between roles.
-Communicate common workplace challenges like misalignment, information silos, and tool overload.
-Arrange people and interactions horizontally in logical teams or departments (e.g., Merchandising, Marketing, Agency).
-Always prioritize clarity, balance, and visual storytelling. Include icons, facial expressions, and directional cues to emphasize communication bottlenecks or inefficiencies.
-If there is too much text or visual content try to reduce the font and keep space for visual clarity.
-Have a proper whiteboard background for clear image.
-Do not rewrite the entire prompt in the diagram. Only clearly illustrate the concept.
-Always only follow the style of the images provided in the knowledge bank."""
+from client_utils import get_client
+from cache_utils import get_cache, make_cache_key
+from scheduler_utils import get_scheduler, split_into_batches
+from metrics_utils import Span, record_cache_hit
+from singleflight_utils import get_single_flight
+from image_utils import EncodedImage, PreparedRef, prepare_refs
+from prompt_utils import DIAGRAM_SYSTEM_PROMPT
 
 # Define valid image sizes
 ImageSize = Literal['256x256', '512x512',
                     '1024x1024', '1536x1024', '1024x1536', 'auto']
 
 
-def generate_diagram(
+def _diagram_cache_key(
+    prompt: str,
+    size: ImageSize,
+    refs: List[PreparedRef],
+    system_prompt: str,
+    variant: int
+) -> str:
+    return make_cache_key(
+        kind="diagram",
+        model="gpt-image-1",
+        system_prompt=system_prompt,
+        prompt=prompt,
+        size=size,
+        refs=[ref.digest for ref in refs],
+        variant=variant
+    )
+
+
+def _request_diagrams(
+    prompt: str,
+    size: ImageSize,
+    refs: List[PreparedRef],
+    system_prompt: str,
+    variants: List[int],
+    span: Span
+) -> List[EncodedImage]:
+    # Time between submission to the pool and a worker picking the call up
+    span.queue_wait += span.elapsed()
+    # Identical requests from other sessions that are already in flight are shared
+    flight_key = "|".join(_diagram_cache_key(prompt, size, refs, system_prompt, variant)
+                          for variant in variants)
+    try:
+        images, shared = get_single_flight().do(
+            flight_key, _call_images_api, prompt, size, refs, system_prompt, variants, span)
+        if shared:
+            span.coalesced = True
+            span.images = len(images)
+        return images
+    except Exception as e:
+        span.error = str(e)
+        raise
+    finally:
+        span.finish()
+
+
+def _call_images_api(
+    prompt: str,
+    size: ImageSize,
+    refs: List[PreparedRef],
+    system_prompt: str,
+    variants: List[int],
+    span: Span
+) -> List[EncodedImage]:
+    # Combine system prompt with user prompt
+    full_prompt = f"{system_prompt}\n\nUser request: {prompt}"
+
+    span.bytes_sent = sum(len(ref.data) for ref in refs)
+    if refs:
+        # For edit-mode
+        response = get_scheduler().call(
+            get_client().images.edit,
+            model="gpt-image-1",
+            image=[ref.as_file(i) for i, ref in enumerate(refs)],
+            prompt=full_prompt,
+            n=len(variants),
+            size=size,
+            span=span
+        )
+    else:
+        # For generation
+        response = get_scheduler().call(
+            get_client().images.generate,
+            model="gpt-image-1",
+            prompt=full_prompt,
+            n=len(variants),
+            size=size,
+            span=span
+        )
+
+    images = []
+    if response and response.data:
+        for variant, datum in zip(variants, response.data):
+            if datum.b64_json:
+                # Keep the PNG bytes as returned; nothing is decoded to pixels here
+                with span.timed("decode_time"):
+                    img = EncodedImage.from_base64(datum.b64_json)
+                span.bytes_received += len(datum.b64_json)
+                span.image_bytes += img.nbytes
+                span.images += 1
+                # Always refresh the cache, so "regenerate" replaces the stored result
+                get_cache().set(_diagram_cache_key(
+                    prompt, size, refs, system_prompt, variant), img.data)
+                images.append(img)
+    return images
+
+
+def generate_diagrams(
     prompt: str,
     size: ImageSize = 'auto',
     refs: Optional[List[BytesIO]] = None,
-    system_prompt: Optional[str] = None
-) -> Optional[Image.Image]:
+    system_prompt: Optional[str] = None,
+    use_cache: bool = True,
+    variants: int = 1
+) -> Generator[EncodedImage, None, None]:
     """
-    Generate a single diagram image for the given prompt.
+    Generate `variants` diagram images for the given prompt.
+    Variants are requested with `n>1` in as few calls as the API allows, and
+    images are yielded as soon as their request returns.
 
     Args:
         prompt: The diagram prompt
         size: Image size
         refs: Optional reference images for editing
         system_prompt: Optional custom system prompt to use
+        use_cache: Serve previously generated images for identical inputs;
+            pass False to force a fresh API call (regenerate)
+        variants: Number of images to generate
     """
     try:
         # Use provided system prompt or default
         current_system_prompt = system_prompt if system_prompt is not None else DIAGRAM_SYSTEM_PROMPT
 
-        # Combine system prompt with user prompt
-        full_prompt = f"{current_system_prompt}\n\nUser request: {prompt}"
-
-        if refs:
-            # For edit-mode, ensure the image is in the correct format
-            processed_refs = []
-            for ref in refs:
-                # Convert to PNG format
-                img = Image.open(ref)
-                png_buffer = BytesIO()
-                img.save(png_buffer, format='PNG')
-                png_buffer.seek(0)
-                processed_refs.append(png_buffer)
-
-            # For edit-mode
-            response = client.images.edit(
-                model="gpt-image-1",
-                image=processed_refs[0],  # Use the first image for editing
-                prompt=full_prompt,
-                n=1,
-                size=size
-            )
-        else:
-            # For generation
-            response = client.images.generate(
-                model="gpt-image-1",
-                prompt=full_prompt,
-                n=1,
-                size=size
-            )
-
-        if response and response.data:
-            for datum in response.data:
-                if datum.b64_json:
-                    img_bytes = base64.b64decode(datum.b64_json)
-                    return Image.open(BytesIO(img_bytes))
-        return None
+        # For edit-mode, convert, downscale and dedupe the references once
+        processed_refs = prepare_refs(refs)
+
+        # Serve cached variants first and only request the missing ones
+        missing = []
+        for variant in range(variants):
+            cached = None
+            if use_cache:
+                cached = get_cache().get(_diagram_cache_key(
+                    prompt, size, processed_refs, current_system_prompt, variant))
+            if cached is not None:
+                record_cache_hit("diagram", size, len(cached))
+                yield EncodedImage(cached)
+            else:
+                missing.append(variant)
+
+        batches = split_into_batches(missing)
+        if not batches:
+            return
+        executor = ThreadPoolExecutor(max_workers=len(batches))
+        try:
+            futures = [
+                executor.submit(_request_diagrams, prompt, size, processed_refs,
+                                current_system_prompt, batch, Span("diagram", size=size, variants=len(batch)))
+                for batch in batches
+            ]
+            for future in as_completed(futures):
+                yield from future.result()
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
 
     except Exception as e:
         raise Exception(f"Error generating diagram image: {str(e)}")
+
+
+def generate_diagram(
+    prompt: str,
+    size: ImageSize = 'auto',
+    refs: Optional[List[BytesIO]] = None,
+    system_prompt: Optional[str] = None,
+    use_cache: bool = True
+) -> Optional[EncodedImage]:
+    """
+    Generate a single diagram image for the given prompt.
+
+    Args:
+        prompt: The diagram prompt
+        size: Image size
+        refs: Optional reference images for editing
+        system_prompt: Optional custom system prompt to use
+        use_cache: Serve a previously generated image for identical inputs;
+            pass False to force a fresh API call (regenerate)
+    """
+    return next(generate_diagrams(
+        prompt=prompt,
+        size=size,
+        refs=refs,
+        system_prompt=system_prompt,
+        use_cache=use_cache
+    ), None)
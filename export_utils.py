@@ -0,0 +1,118 @@
+import json
+import math
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from typing import Callable, Dict, Iterator, List, Sequence, Tuple, Union
+from PIL import Image
+
+# Square sizes every icon is exported at
+ICON_LADDER = (16, 24, 32, 48, 64, 128, 256, 512)
+
+# Sprite sheets are only packed for sizes up to this; bigger sheets get unwieldy
+MAX_SPRITE_SIZE = 128
+
+# Downscales by more than this factor start with an integer box reduction (see Image.resize)
+RESIZE_REDUCING_GAP = 3.0
+
+# Threads resizing icons in parallel (Pillow releases the GIL while resampling)
+MAX_EXPORT_WORKERS = 4
+
+
+def _encode_png(img: Image.Image) -> bytes:
+    buf = BytesIO()
+    img.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def render_ladder(data: bytes, sizes: Sequence[int] = ICON_LADDER) -> Dict[int, Image.Image]:
+    """
+    Decode an icon once and resize it to every size in `sizes`.
+
+    Non-square icons are centred on a transparent square. Every rung is
+    resampled from the decoded square, so small sizes don't accumulate the
+    blur of repeated filtering; `reducing_gap` lets Pillow shrink large
+    factors with a cheap box reduction before the final LANCZOS pass.
+
+    Args:
+        data: Encoded icon image
+        sizes: Square sizes in pixels
+    """
+    img = Image.open(BytesIO(data)).convert("RGBA")
+    side = max(img.width, img.height)
+    if img.width != img.height:
+        square = Image.new("RGBA", (side, side), (0, 0, 0, 0))
+        square.paste(img, ((side - img.width) // 2, (side - img.height) // 2))
+        img = square
+
+    return {
+        size: img if size == side else img.resize((size, size), Image.LANCZOS, reducing_gap=RESIZE_REDUCING_GAP)
+        for size in sorted(set(sizes))
+    }
+
+
+def pack_sprite_sheet(icons: List[Tuple[str, Image.Image]], size: int) -> Tuple[Image.Image, Dict[str, Dict[str, int]]]:
+    """
+    Pack same-sized icons into a near-square grid.
+
+    Args:
+        icons: (name, image) pairs, all `size` x `size`
+        size: Icon side length in pixels
+
+    Returns:
+        The sheet and an index mapping each name to its x, y, w, h
+    """
+    columns = max(1, math.ceil(math.sqrt(len(icons))))
+    rows = max(1, math.ceil(len(icons) / columns))
+    sheet = Image.new("RGBA", (columns * size, rows * size), (0, 0, 0, 0))
+    index = {}
+    for i, (name, img) in enumerate(icons):
+        x, y = (i % columns) * size, (i // columns) * size
+        sheet.paste(img, (x, y))
+        index[name] = {"x": x, "y": y, "w": size, "h": size}
+    return sheet, index
+
+
+def build_icon_export(
+    icons: List[Tuple[str, Union[bytes, Callable[[], bytes]]]],
+    sizes: Sequence[int] = ICON_LADDER,
+    max_workers: int = MAX_EXPORT_WORKERS
+) -> Iterator[Tuple[str, bytes]]:
+    """
+    Size ladder and sprite sheets for a set of icons, as files for `build_zip`.
+
+    Every icon is decoded once; its ladder is rendered in parallel with the
+    other icons'. Yields `icons/<size>/<name>.png` for each rung, one
+    `sprites/sprite_<size>.png` per size up to MAX_SPRITE_SIZE and
+    `sprites/sprites.json` with the coordinates of every icon on each sheet.
+
+    Args:
+        icons: (name, encoded image) pairs; names must be unique. The image
+            may be a callable loading it, so only the icons being resized are
+            held in memory
+        sizes: Square sizes in pixels
+        max_workers: Icons resized at once
+    """
+    sizes = sorted(set(sizes))
+    sprite_sizes = [size for size in sizes if size <= MAX_SPRITE_SIZE]
+
+    def export(icon: Tuple[str, Union[bytes, Callable[[], bytes]]]) -> Tuple[List[Tuple[str, bytes]], Dict[int, Image.Image]]:
+        name, data = icon
+        ladder = render_ladder(data() if callable(data) else data, sizes)
+        files = [(f"icons/{size}/{name}.png", _encode_png(ladder[size])) for size in sizes]
+        # Only the small rungs are kept for the sprite sheets
+        return files, {size: ladder[size] for size in sprite_sizes}
+
+    sprites: List[Dict[int, Image.Image]] = []
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        for files, small in executor.map(export, icons):
+            sprites.append(small)
+            yield from files
+
+    index = {}
+    for size in sprite_sizes:
+        sheet, positions = pack_sprite_sheet(
+            [(name, small[size]) for (name, _), small in zip(icons, sprites)], size)
+        file_name = f"sprite_{size}.png"
+        index[file_name] = {"size": size, "icons": positions}
+        yield f"sprites/{file_name}", _encode_png(sheet)
+    yield "sprites/sprites.json", json.dumps(index, indent=2).encode()
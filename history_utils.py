@@ -0,0 +1,180 @@
+import os
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Iterator, List, NamedTuple, Optional
+from cache_utils import hash_bytes, write_file_atomic
+from image_utils import EncodedImage, PREVIEW_FORMAT, THUMBNAIL_WIDTH
+
+# Location of the persistent generation history (overridable via environment)
+DEFAULT_HISTORY_DIR = os.environ.get("IMAGE_HISTORY_DIR", ".image_history")
+
+# Preview widths rendered when an image is stored; other widths are rendered on first use
+PREVIEW_WIDTHS = (THUMBNAIL_WIDTH,)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    prompt TEXT NOT NULL,
+    blob TEXT NOT NULL,
+    nbytes INTEGER NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS images_by_user ON images (username, kind, id);
+"""
+
+
+class HistoryEntry(NamedTuple):
+    """Metadata for one stored image; the bytes live in the blob directory."""
+    id: int
+    username: str
+    kind: str
+    prompt: str
+    blob: str
+    nbytes: int
+    created_at: float
+
+
+class HistoryStore:
+    """
+    Disk-backed history of generated images per user.
+
+    Metadata lives in a SQLite database and image bytes in a content-addressed
+    blob directory, so identical images are stored once and nothing has to be
+    held in Streamlit session state. Each blob gets display-sized previews next
+    to it, so pages never send full-resolution images to the browser.
+    """
+
+    def __init__(self, directory: str = DEFAULT_HISTORY_DIR):
+        self.directory = directory
+        self.blob_dir = os.path.join(directory, "blobs")
+        os.makedirs(self.blob_dir, exist_ok=True)
+        self.db_path = os.path.join(directory, "history.db")
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        # A short-lived connection per call keeps the store safe to share across threads
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _blob_path(self, blob: str) -> str:
+        return os.path.join(self.blob_dir, blob[:2], f"{blob}.png")
+
+    def _preview_path(self, blob: str, width: int) -> str:
+        return os.path.join(self.blob_dir, blob[:2], f"{blob}.w{width}.{PREVIEW_FORMAT.lower()}")
+
+    def add(self, username: str, kind: str, prompt: str, data: bytes) -> int:
+        """
+        Store an image and return its history id.
+
+        Args:
+            username: Owner of the image
+            kind: Generator type ("icon" or "diagram")
+            prompt: Prompt the image was generated from
+            data: Encoded image bytes
+        """
+        blob = hash_bytes(data)
+        path = self._blob_path(blob)
+        if not os.path.exists(path):
+            image = EncodedImage(data)
+            for width in PREVIEW_WIDTHS:
+                write_file_atomic(self._preview_path(blob, width), image.thumbnail(width, PREVIEW_FORMAT))
+            # The original goes last: its presence marks the previews as complete
+            write_file_atomic(path, data)
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "INSERT INTO images (username, kind, prompt, blob, nbytes, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (username, kind, prompt, blob, len(data), time.time())
+            )
+            return cursor.lastrowid
+
+    def count(self, username: str, kind: str) -> int:
+        """Number of stored images of `kind` for `username`."""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT COUNT(*) FROM images WHERE username = ? AND kind = ?",
+                (username, kind)
+            ).fetchone()
+        return row[0]
+
+    def latest_id(self, username: str, kind: str) -> Optional[int]:
+        """Id of the newest entry of `kind` for `username`; changes whenever one is added."""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT MAX(id) FROM images WHERE username = ? AND kind = ?",
+                (username, kind)
+            ).fetchone()
+        return row[0]
+
+    def page(self, username: str, kind: str, offset: int = 0, limit: int = 12) -> List[HistoryEntry]:
+        """
+        One page of a user's history, newest first.
+
+        Args:
+            username: Owner of the images
+            kind: Generator type ("icon" or "diagram")
+            offset: Number of newer entries to skip
+            limit: Maximum number of entries to return (-1 for all)
+        """
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT id, username, kind, prompt, blob, nbytes, created_at FROM images "
+                "WHERE username = ? AND kind = ? ORDER BY id DESC LIMIT ? OFFSET ?",
+                (username, kind, limit, offset)
+            ).fetchall()
+        return [HistoryEntry(*row) for row in rows]
+
+    def get(self, entry_id: int) -> Optional[HistoryEntry]:
+        """Look up a single entry by id."""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT id, username, kind, prompt, blob, nbytes, created_at FROM images WHERE id = ?",
+                (entry_id,)
+            ).fetchone()
+        return HistoryEntry(*row) if row else None
+
+    def load(self, entry: HistoryEntry) -> bytes:
+        """Read the full image bytes for an entry."""
+        with open(self._blob_path(entry.blob), "rb") as f:
+            return f.read()
+
+    def preview(self, entry: HistoryEntry, width: int = THUMBNAIL_WIDTH) -> bytes:
+        """
+        Display-sized rendition of an entry (WebP where Pillow supports it).
+
+        Args:
+            entry: Stored image
+            width: Maximum width; renditions missing on disk are rendered and kept
+        """
+        path = self._preview_path(entry.blob, width)
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            data = EncodedImage(self.load(entry)).thumbnail(width, PREVIEW_FORMAT)
+            write_file_atomic(path, data)
+            return data
+
+
+_store: Optional[HistoryStore] = None
+_store_lock = threading.Lock()
+
+
+def get_history_store() -> HistoryStore:
+    """Return the process-wide history store, creating it on first use."""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = HistoryStore()
+        return _store
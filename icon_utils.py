@@ -1,92 +1,236 @@
 import os
-import base64
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from io import BytesIO
-from typing import List, Optional, Literal, Union, Generator
-import streamlit as st
-from openai import OpenAI
-from PIL import Image
-
-# Initialize OpenAI client with API key from secrets
-client = OpenAI(api_key=st.secrets["openai"]["api_key"])
-
-# System prompt for icon generation
-ICON_SYSTEM_PROMPT = """You are a visual design assistant that generates prompts for creating icons in a luxurious, minimalistic, slightly 3D style with a transparent background. The background should always be transparent.
-
-When the user inputs a shortphrase, your job is to analyze the text input and decide what text and icon the card should contain. Then automatically format it into the following prompt structure:
-
-"Create an image of a minimalistic luxury slight 3D style card icon with a transparent background, like a $10,000 design team's work, of the word "xyz" with a graphic of a "abc". Make the background transparent."
-
-Always consider the full prompt exactly as above with the text inserted cleanly into "xyz" and "abc" — replacing "xyz" with the label/text the icon should feature, and "abc" with the visual graphic or symbol they mentioned. Do not include anything else in your reply.
-
-Make sure it is in a card style. The text and any graphic on the card should be flat 2D black printed on the card. the card should be slightly 3d and the colour of the card should always be #f9f1dd. Make sure the background is ALWAYS FULLY TRANSPARENT. Make sure to use Montserrat font and ALWAYS USE CAPITAL letters when generating Icon. All Icons should be in consistent style, font, and layout."""
+from typing import Callable, List, Optional, Literal, Union, Generator
+from client_utils import get_client
+from cache_utils import get_cache, make_cache_key
+from scheduler_utils import get_scheduler, split_into_batches
+from metrics_utils import Span, record_cache_hit
+from singleflight_utils import get_single_flight
+from image_utils import EncodedImage, PreparedRef, prepare_refs
+from prompt_utils import ICON_SYSTEM_PROMPT
 
 # Define valid image sizes
 ImageSize = Literal['256x256', '512x512',
                     '1024x1024', '1536x1024', '1024x1536', 'auto']
 
+# Default number of API requests kept in flight for a batch of icons
+MAX_CONCURRENT_REQUESTS = 4
+
+
+def _icon_cache_key(
+    prompt: str,
+    size: ImageSize,
+    refs: List[PreparedRef],
+    system_prompt: str,
+    variant: int
+) -> str:
+    return make_cache_key(
+        kind="icon",
+        model="gpt-image-1",
+        system_prompt=system_prompt,
+        prompt=prompt,
+        size=size,
+        refs=[ref.digest for ref in refs],
+        variant=variant
+    )
+
+
+def _generate_icon(
+    prompt: str,
+    size: ImageSize,
+    refs: List[PreparedRef],
+    system_prompt: str,
+    variants: List[int],
+    span: Span,
+    cancel: Optional[threading.Event] = None
+) -> List[EncodedImage]:
+    """
+    Run a single generate/edit call returning several variants of one icon prompt.
+
+    Args:
+        prompt: The icon prompt
+        size: Image size
+        refs: Reference images prepared by `prepare_refs`
+        system_prompt: System prompt to prepend to the user prompt
+        variants: Variant slots this call fills (one image is requested per slot)
+        span: Metrics span for this request, finished when the call returns
+        cancel: Optional event; once set, the call is skipped if not yet started
+    """
+    if cancel is not None and cancel.is_set():
+        return []
+    # Time between submission to the pool and a worker picking the call up
+    span.queue_wait += span.elapsed()
+    # Identical requests from other sessions that are already in flight are shared
+    flight_key = "|".join(_icon_cache_key(prompt, size, refs, system_prompt, variant)
+                          for variant in variants)
+    try:
+        images, shared = get_single_flight().do(
+            flight_key, _request_icons, prompt, size, refs, system_prompt, variants, span)
+        if shared:
+            span.coalesced = True
+            span.images = len(images)
+        return images
+    except Exception as e:
+        span.error = str(e)
+        raise
+    finally:
+        span.finish()
+
+
+def _request_icons(
+    prompt: str,
+    size: ImageSize,
+    refs: List[PreparedRef],
+    system_prompt: str,
+    variants: List[int],
+    span: Span
+) -> List[EncodedImage]:
+    # Combine system prompt with user prompt
+    full_prompt = f"{system_prompt}\n\nUser request: {prompt}"
+
+    span.bytes_sent = sum(len(ref.data) for ref in refs)
+    if refs:
+        # For edit-mode, send every reference the endpoint accepts
+        response = get_scheduler().call(
+            get_client().images.edit,
+            model="gpt-image-1",
+            image=[ref.as_file(i) for i, ref in enumerate(refs)],
+            prompt=full_prompt,
+            n=len(variants),
+            size=size,
+            span=span
+        )
+    else:
+        # For generation
+        response = get_scheduler().call(
+            get_client().images.generate,
+            model="gpt-image-1",
+            prompt=full_prompt,
+            n=len(variants),
+            size=size,
+            span=span
+        )
+
+    images = []
+    if response and response.data:
+        for variant, datum in zip(variants, response.data):
+            if datum.b64_json:
+                # Keep the PNG bytes as returned; nothing is decoded to pixels here
+                with span.timed("decode_time"):
+                    img = EncodedImage.from_base64(datum.b64_json)
+                span.bytes_received += len(datum.b64_json)
+                span.image_bytes += img.nbytes
+                span.images += 1
+                # Always refresh the cache, so "regenerate" replaces the stored result
+                get_cache().set(_icon_cache_key(
+                    prompt, size, refs, system_prompt, variant), img.data)
+                images.append(img)
+    return images
+
 
 def generate_icons(
     prompts: Union[str, List[str]],
     size: ImageSize = 'auto',
     refs: Optional[List[BytesIO]] = None,
-    system_prompt: Optional[str] = None
-) -> Generator[tuple[Image.Image, str], None, None]:
+    system_prompt: Optional[str] = None,
+    max_concurrency: int = MAX_CONCURRENT_REQUESTS,
+    use_cache: bool = True,
+    on_error: Optional[Callable[[str, Exception], None]] = None,
+    variants: int = 1,
+    cancel: Optional[threading.Event] = None
+) -> Generator[tuple[EncodedImage, str], None, None]:
     """
     Generate icon images for each prompt in the list.
     If a single string is provided, it will be treated as a list with one item.
-    Yields tuples of (image, prompt) as they are generated.
+    Requests run concurrently (at most `max_concurrency` in flight) and
+    tuples of (image, prompt) are yielded in completion order.
+
+    Duplicate prompts are generated once. Each prompt produces `variants`
+    images. Variants are requested with `n>1` in as few calls as the API
+    allows, and only variants missing from the cache are requested.
+
+    A prompt that still fails after the scheduler's retries does not stop the
+    batch: it is passed to `on_error`, or, without a callback, all failures are
+    raised together once every other prompt has been yielded.
 
     Args:
         prompts: Single prompt or list of prompts
         size: Image size
         refs: Optional reference images for editing
         system_prompt: Optional custom system prompt to use
+        max_concurrency: Maximum number of API requests in flight at once
+        use_cache: Serve previously generated images for identical inputs;
+            pass False to force a fresh API call (regenerate)
+        on_error: Optional callback receiving (prompt, error) for failed prompts
+        variants: Number of images to generate per prompt
+        cancel: Optional event; once set, queued requests are skipped and the
+            generator stops after the next request in flight completes
     """
     try:
         # Convert single prompt to list
         if isinstance(prompts, str):
             prompts = [prompts]
+        # Repeated prompts would only request (and yield) the same images twice
+        prompts = list(dict.fromkeys(prompts))
 
         # Use provided system prompt or default
         current_system_prompt = system_prompt if system_prompt is not None else ICON_SYSTEM_PROMPT
 
+        # For edit-mode, convert the references once for the whole batch
+        prepared_refs = prepare_refs(refs)
+
+        # Serve cached variants first and work out which slots still need the API
+        cached_images = []
+        missing = {}
         for prompt in prompts:
-            # Combine system prompt with user prompt
-            full_prompt = f"{current_system_prompt}\n\nUser request: {prompt}"
-
-            if refs:
-                # For edit-mode, ensure the image is in the correct format
-                processed_refs = []
-                for ref in refs:
-                    img = Image.open(ref)
-                    png_buffer = BytesIO()
-                    img.save(png_buffer, format='PNG')
-                    png_buffer.seek(0)
-                    processed_refs.append(png_buffer)
-
-                # For edit-mode
-                response = client.images.edit(
-                    model="gpt-image-1",
-                    image=processed_refs[0],
-                    prompt=full_prompt,
-                    n=1,
-                    size=size
-                )
-            else:
-                # For generation
-                response = client.images.generate(
-                    model="gpt-image-1",
-                    prompt=full_prompt,
-                    n=1,
-                    size=size
-                )
-
-            if response and response.data:
-                for datum in response.data:
-                    if datum.b64_json:
-                        img_bytes = base64.b64decode(datum.b64_json)
-                        img = Image.open(BytesIO(img_bytes))
-                        yield img, prompt
+            for variant in range(variants):
+                cached = None
+                if use_cache:
+                    cached = get_cache().get(_icon_cache_key(
+                        prompt, size, prepared_refs, current_system_prompt, variant))
+                if cached is not None:
+                    cached_images.append((EncodedImage(cached), prompt))
+                    record_cache_hit("icon", size, len(cached))
+                else:
+                    missing.setdefault(prompt, []).append(variant)
+
+        executor = ThreadPoolExecutor(max_workers=max(1, max_concurrency))
+        try:
+            futures = {}
+            for prompt, slots in missing.items():
+                for batch in split_into_batches(slots):
+                    span = Span("icon", size=size, variants=len(batch))
+                    future = executor.submit(
+                        _generate_icon, prompt, size, prepared_refs, current_system_prompt, batch, span, cancel)
+                    futures[future] = prompt
+
+            for img, prompt in cached_images:
+                yield img, prompt
+
+            failures = []
+            for future in as_completed(futures):
+                if cancel is not None and cancel.is_set():
+                    break
+                prompt = futures[future]
+                try:
+                    images = future.result()
+                except Exception as e:
+                    if on_error is None:
+                        failures.append((prompt, e))
+                    else:
+                        on_error(prompt, e)
+                    continue
+                for img in images:
+                    yield img, prompt
+        finally:
+            # Drop queued requests if the caller stops consuming early
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        if failures:
+            details = "; ".join(f"{prompt!r}: {e}" for prompt, e in failures)
+            raise Exception(f"{len(failures)} request(s) failed ({details})")
 
     except Exception as e:
         raise Exception(f"Error generating icon images: {str(e)}")
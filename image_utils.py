@@ -0,0 +1,253 @@
+import os
+import json
+import base64
+import weakref
+import tempfile
+from io import BytesIO
+from typing import IO, Any, Dict, Iterable, List, Optional, Tuple, Union
+from PIL import Image, ImageOps, features
+from cache_utils import hash_bytes
+
+# Width (in pixels) of the previews shown in the gallery column
+THUMBNAIL_WIDTH = 512
+
+# Display-only previews: WebP is several times smaller than PNG at the same width
+PREVIEW_FORMAT = "WEBP" if features.check("webp") else "PNG"
+PREVIEW_QUALITY = 80
+
+# Longest side worth uploading as a reference; the API never outputs more than this
+MAX_REF_DIMENSION = 1536
+
+# Maximum number of reference images the edit endpoint accepts in one call
+MAX_REFS = 16
+
+# ZIP archives bigger than this spill from memory to a temporary file
+ZIP_SPOOL_MAX_BYTES = 32 * 1024 * 1024
+
+
+def _remove_file(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class EncodedImage:
+    """
+    A generated image kept as its encoded bytes.
+
+    The bytes are what gets displayed, downloaded and zipped; the PIL image and
+    thumbnails are only decoded/encoded the first time they are asked for and
+    then reused across Streamlit reruns. Under memory pressure they can be
+    dropped (`release`) and the bytes moved to disk (`spill`); both come back
+    transparently on next use.
+    """
+
+    def __init__(self, data: bytes):
+        self._data: Optional[bytes] = data
+        self._path: Optional[str] = None
+        self._nbytes = len(data)
+        self._image: Optional[Image.Image] = None
+        self._thumbnails: Dict[Tuple[int, str], bytes] = {}
+
+    @classmethod
+    def from_base64(cls, b64_data: str) -> "EncodedImage":
+        """Wrap an API `b64_json` payload without decoding it to pixels."""
+        return cls(base64.b64decode(b64_data))
+
+    @classmethod
+    def from_pil(cls, img: Image.Image) -> "EncodedImage":
+        """Encode a PIL image to PNG once and wrap it."""
+        buf = BytesIO()
+        img.save(buf, format='PNG')
+        encoded = cls(buf.getvalue())
+        encoded._image = img
+        return encoded
+
+    @property
+    def data(self) -> bytes:
+        """Encoded bytes, read back from disk if they were spilled."""
+        if self._data is None:
+            with open(self._path, "rb") as f:
+                self._data = f.read()
+        return self._data
+
+    @property
+    def view(self) -> memoryview:
+        """Zero-copy view of the encoded bytes."""
+        return memoryview(self.data)
+
+    @property
+    def nbytes(self) -> int:
+        """Size of the encoded image in bytes."""
+        return self._nbytes
+
+    def memory_usage(self) -> int:
+        """Approximate bytes held in memory: encoded data, decoded pixels and thumbnails."""
+        size = len(self._data) if self._data is not None else 0
+        if self._image is not None:
+            size += self._image.width * self._image.height * len(self._image.getbands())
+        return size + sum(len(thumb) for thumb in self._thumbnails.values() if thumb is not self._data)
+
+    def release(self) -> int:
+        """Drop the decoded image and thumbnails; returns the bytes freed."""
+        freed = self.memory_usage() - (len(self._data) if self._data is not None else 0)
+        self._image = None
+        self._thumbnails.clear()
+        return freed
+
+    def spill(self, directory: str) -> int:
+        """
+        Move the encoded bytes to a file in `directory`; returns the bytes freed.
+
+        Args:
+            directory: Where to write the file; it is deleted with this object
+        """
+        if self._data is None:
+            return 0
+        if self._path is None:
+            os.makedirs(directory, exist_ok=True)
+            fd, self._path = tempfile.mkstemp(dir=directory, suffix=".png")
+            with os.fdopen(fd, "wb") as f:
+                f.write(self._data)
+            weakref.finalize(self, _remove_file, self._path)
+        freed = len(self._data)
+        self._data = None
+        return freed
+
+    @property
+    def image(self) -> Image.Image:
+        """Decoded PIL view of the image (decoded on first access)."""
+        if self._image is None:
+            self._image = Image.open(BytesIO(self.data))
+        return self._image
+
+    def thumbnail(self, width: int = THUMBNAIL_WIDTH, format: str = 'PNG') -> bytes:
+        """
+        Encoded bytes of the image scaled down to `width` pixels wide.
+
+        Args:
+            width: Maximum width of the thumbnail
+            format: Pillow format name, e.g. 'PNG' or PREVIEW_FORMAT
+        """
+        key = (width, format)
+        if key not in self._thumbnails:
+            img = self.image
+            if img.width <= width and format == 'PNG':
+                self._thumbnails[key] = self.data
+            else:
+                if img.width > width:
+                    height = max(1, round(img.height * width / img.width))
+                    img = img.resize((width, height), Image.LANCZOS)
+                buf = BytesIO()
+                img.save(buf, format=format, quality=PREVIEW_QUALITY)
+                self._thumbnails[key] = buf.getvalue()
+        return self._thumbnails[key]
+
+
+class PreparedRef:
+    """A reference image converted once to PNG, ready to upload and hash."""
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.digest = hash_bytes(data)
+
+    def as_file(self, index: int = 0) -> Tuple[str, bytes, str]:
+        """
+        Upload tuple for the OpenAI SDK. A fresh tuple per call keeps it safe
+        to reuse from several threads.
+
+        Args:
+            index: Position of the reference, used for the upload file name
+        """
+        return (f"ref_{index}.png", self.data, "image/png")
+
+
+def _prepare_ref(raw: bytes) -> bytes:
+    img = Image.open(BytesIO(raw))
+    # Phone photos are often stored sideways with an EXIF rotation flag
+    rotated = img.getexif().get(0x0112, 1) != 1
+    needs_resize = max(img.size) > MAX_REF_DIMENSION
+    if img.format == 'PNG' and not rotated and not needs_resize:
+        # Already an upright PNG of a useful size; upload it untouched
+        return raw
+
+    if rotated:
+        img = ImageOps.exif_transpose(img)
+    if needs_resize:
+        img.thumbnail((MAX_REF_DIMENSION, MAX_REF_DIMENSION), Image.LANCZOS)
+    if img.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+        img = img.convert('RGBA' if 'A' in img.getbands() or 'transparency' in img.info else 'RGB')
+    buf = BytesIO()
+    img.save(buf, format='PNG')
+    return buf.getvalue()
+
+
+def prepare_refs(refs: Optional[List[Union[BytesIO, bytes]]]) -> List[PreparedRef]:
+    """
+    Convert uploaded reference images into PNGs the edit endpoint accepts.
+
+    Each upload is converted exactly once: rotated upright, downscaled to
+    MAX_REF_DIMENSION, re-encoded to PNG only when needed, hashed for cache
+    keys, and dropped if it duplicates an earlier upload. At most MAX_REFS
+    references are returned.
+
+    Args:
+        refs: Uploaded reference images (file buffers or raw bytes)
+    """
+    prepared: List[PreparedRef] = []
+    seen_uploads = set()
+    seen_outputs = set()
+    for ref in refs or []:
+        raw = ref if isinstance(ref, bytes) else ref.getvalue()
+        # Skip byte-identical uploads before doing any decode work
+        raw_digest = hash_bytes(raw)
+        if raw_digest in seen_uploads:
+            continue
+        seen_uploads.add(raw_digest)
+
+        # Different files can still convert to the same PNG (e.g. re-saved copies)
+        prepared_ref = PreparedRef(_prepare_ref(raw))
+        if prepared_ref.digest in seen_outputs:
+            continue
+        seen_outputs.add(prepared_ref.digest)
+        prepared.append(prepared_ref)
+        if len(prepared) == MAX_REFS:
+            break
+    return prepared
+
+
+def build_zip(
+    files: Iterable[Tuple[str, bytes]],
+    manifest: Optional[List[Dict[str, Any]]] = None
+) -> IO[bytes]:
+    """
+    Bundle already-encoded files into a ZIP archive backed by a spooled temp file.
+
+    Entries are stored uncompressed (PNGs don't deflate) and written one at a
+    time, so `files` can be a generator that loads each file on demand and only
+    one image is held in memory while the archive is built.
+
+    Args:
+        files: (file name, file bytes) pairs
+        manifest: Optional records to include as manifest.json
+
+    Returns:
+        The archive file object, rewound to the start
+    """
+    import zipfile
+
+    archive = tempfile.SpooledTemporaryFile(max_size=ZIP_SPOOL_MAX_BYTES)
+    with zipfile.ZipFile(archive, 'w', compression=zipfile.ZIP_STORED) as zipf:
+        for fname, data in files:
+            zipf.writestr(fname, data)
+        if manifest is not None:
+            zipf.writestr("manifest.json", json.dumps(manifest, indent=2))
+    archive.seek(0)
+    return archive
+
+
+def read_archive(archive: IO[bytes]) -> bytes:
+    """Full contents of an archive from `build_zip`, e.g. as deferred download data."""
+    archive.seek(0)
+    return archive.read()
@@ -0,0 +1,232 @@
+import os
+import time
+import uuid
+import threading
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+from history_utils import get_history_store
+
+# Number of generation jobs run at once per server, across all sessions
+DEFAULT_JOB_WORKERS = int(os.environ.get("IMAGE_JOB_WORKERS", "4"))
+
+# Finished jobs are forgotten after this many seconds
+JOB_RETENTION_SECONDS = 3600
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED_STATUSES = (DONE, FAILED, CANCELLED)
+
+
+class Job:
+    """
+    A generation request running on the background queue.
+
+    Workers append history ids to `results` as images land, so the UI can
+    render partial results while the job is still running.
+    """
+
+    def __init__(self, username: str, kind: str, description: str, total: int):
+        self.id = uuid.uuid4().hex[:12]
+        self.username = username
+        self.kind = kind
+        self.description = description
+        self.total = total
+        self.status = QUEUED
+        self.results: List[int] = []
+        self.errors: List[str] = []
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self._cancel = threading.Event()
+
+    @property
+    def cancelled(self) -> bool:
+        """Whether cancellation was requested; workers check this between images."""
+        return self._cancel.is_set()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in FINISHED_STATUSES
+
+    def cancel(self) -> None:
+        """Stop the job after the image currently in flight; queued jobs never start."""
+        self._cancel.set()
+        if self.status == QUEUED:
+            self.status = CANCELLED
+            self.finished_at = time.time()
+
+
+class JobQueue:
+    """Per-process pool of generation workers shared by every Streamlit session."""
+
+    def __init__(self, max_workers: int = DEFAULT_JOB_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="image-job")
+        self._jobs: Dict[str, Job] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, job: Job, work: Callable[[Job], None]) -> str:
+        """
+        Queue `work(job)` and return the job id immediately.
+
+        Args:
+            job: The job record the worker reports progress into
+            work: Function producing the job's images
+        """
+        with self._lock:
+            self._prune()
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job, work)
+        return job.id
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> None:
+        job = self.get(job_id)
+        if job is not None:
+            job.cancel()
+
+    def _run(self, job: Job, work: Callable[[Job], None]) -> None:
+        if job.cancelled:
+            return
+        job.status = RUNNING
+        try:
+            work(job)
+            job.status = CANCELLED if job.cancelled else DONE
+        except Exception as e:
+            job.errors.append(str(e))
+            job.status = FAILED
+        finally:
+            job.finished_at = time.time()
+
+    def _prune(self) -> None:
+        cutoff = time.time() - JOB_RETENTION_SECONDS
+        for job_id, job in list(self._jobs.items()):
+            if job.finished and job.finished_at and job.finished_at < cutoff:
+                del self._jobs[job_id]
+
+
+def submit_icon_job(
+    queue: JobQueue,
+    username: str,
+    prompts: List[str],
+    refs: Optional[List[bytes]],
+    system_prompt: Optional[str],
+    use_cache: bool = True,
+    variants: int = 1,
+    postprocess: bool = False
+) -> str:
+    """
+    Queue an icon batch; every image is saved to the user's history as it lands.
+
+    Args:
+        queue: Job queue to run on
+        username: Owner of the generated images
+        prompts: Icon prompts
+        refs: Optional reference images as raw bytes
+        system_prompt: Optional custom system prompt
+        use_cache: Serve previously generated images for identical inputs
+        variants: Images per prompt
+        postprocess: Clean up each icon locally (see `postprocess_utils`) before saving
+    """
+    from icon_utils import generate_icons
+
+    # generate_icons runs repeated prompts once
+    job = Job(username, "icon", ", ".join(prompts), total=len(set(prompts)) * variants)
+
+    def work(job: Job) -> None:
+        history = get_history_store()
+        images = generate_icons(
+            prompts=prompts,
+            refs=[BytesIO(ref) for ref in refs] if refs else None,
+            system_prompt=system_prompt,
+            use_cache=use_cache,
+            on_error=lambda prompt, e: job.errors.append(f"{prompt}: {e}"),
+            variants=variants,
+            cancel=job._cancel
+        )
+
+        def encoded() -> Iterator[Tuple[bytes, str]]:
+            try:
+                for img, prompt in images:
+                    yield img.data, prompt
+            finally:
+                # Closing the generator drops its queued API requests
+                images.close()
+
+        results = encoded()
+        if postprocess:
+            from postprocess_utils import postprocess_icons
+            # Takes over closing `encoded()`, from its feeder thread
+            results = postprocess_icons(results)
+        try:
+            for data, prompt in results:
+                job.results.append(history.add(username, "icon", prompt, data))
+                if job.cancelled:
+                    break
+        finally:
+            results.close()
+
+    return queue.submit(job, work)
+
+
+def submit_diagram_job(
+    queue: JobQueue,
+    username: str,
+    prompt: str,
+    refs: Optional[List[bytes]],
+    system_prompt: Optional[str],
+    use_cache: bool = True,
+    variants: int = 1
+) -> str:
+    """
+    Queue diagram generation; every image is saved to the user's history as it lands.
+
+    Args:
+        queue: Job queue to run on
+        username: Owner of the generated images
+        prompt: Diagram prompt
+        refs: Optional reference images as raw bytes
+        system_prompt: Optional custom system prompt
+        use_cache: Serve previously generated images for identical inputs
+        variants: Number of images
+    """
+    from diagram_utils import generate_diagrams
+
+    job = Job(username, "diagram", prompt, total=variants)
+
+    def work(job: Job) -> None:
+        history = get_history_store()
+        images = generate_diagrams(
+            prompt=prompt,
+            refs=[BytesIO(ref) for ref in refs] if refs else None,
+            system_prompt=system_prompt,
+            use_cache=use_cache,
+            variants=variants
+        )
+        try:
+            for img in images:
+                job.results.append(history.add(username, "diagram", prompt, img.data))
+                if job.cancelled:
+                    break
+        finally:
+            images.close()
+
+    return queue.submit(job, work)
+
+
+_queue: Optional[JobQueue] = None
+_queue_lock = threading.Lock()
+
+
+def get_job_queue() -> JobQueue:
+    """Return the process-wide job queue, creating it on first use."""
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = JobQueue()
+        return _queue
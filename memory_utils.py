@@ -0,0 +1,124 @@
+import os
+import tempfile
+from collections import OrderedDict
+from tempfile import SpooledTemporaryFile
+from typing import IO, Any, Hashable, Optional, Set
+from image_utils import ZIP_SPOOL_MAX_BYTES, EncodedImage
+
+# Memory each Streamlit session may hold in images and archives (overridable via environment)
+DEFAULT_SESSION_MEMORY_BUDGET = int(float(os.environ.get("IMAGE_SESSION_MEMORY_MB", "64")) * 1024 * 1024)
+
+# Where demoted image bytes are written
+DEFAULT_SPILL_DIR = os.environ.get(
+    "IMAGE_SPILL_DIR", os.path.join(tempfile.gettempdir(), "image_playground_spill"))
+
+
+def file_size(file: IO[bytes]) -> int:
+    """Length of a seekable file, leaving its position unchanged."""
+    position = file.tell()
+    size = file.seek(0, os.SEEK_END)
+    file.seek(position)
+    return size
+
+
+def memory_usage(value: Any) -> int:
+    """
+    Approximate bytes `value` holds in memory (0 for untracked types).
+
+    A spooled archive counts in full until it outgrows ZIP_SPOOL_MAX_BYTES and
+    spools itself to disk; archives rolled over by `demote` are tracked by
+    `SessionMemory`.
+    """
+    if isinstance(value, EncodedImage):
+        return value.memory_usage()
+    if isinstance(value, SpooledTemporaryFile):
+        size = file_size(value)
+        return size if size <= ZIP_SPOOL_MAX_BYTES else 0
+    return 0
+
+
+def demote(value: Any, spill_dir: str = DEFAULT_SPILL_DIR) -> int:
+    """
+    Move `value` one step down the memory hierarchy and return the bytes freed.
+
+    Images first drop their decoded pixels and thumbnails, then move their
+    encoded bytes to disk. Spooled archives roll over to disk; the caller
+    must remember that, as the archive still reports its size afterwards.
+    Returns 0 once nothing more can be freed.
+
+    Args:
+        value: Tracked value
+        spill_dir: Directory for spilled image bytes
+    """
+    if isinstance(value, EncodedImage):
+        return value.release() or value.spill(spill_dir)
+    if isinstance(value, SpooledTemporaryFile):
+        freed = memory_usage(value)
+        value.rollover()
+        return freed
+    return 0
+
+
+class SessionMemory:
+    """
+    Per-session store for images and archives under a memory budget.
+
+    Values are kept in least-recently-used order. When the total exceeds the
+    budget, the oldest values are demoted (see `demote`) until it fits again;
+    demoted values reload from disk when next used.
+    """
+
+    def __init__(self, budget: int = DEFAULT_SESSION_MEMORY_BUDGET, spill_dir: str = DEFAULT_SPILL_DIR):
+        self.budget = budget
+        self.spill_dir = spill_dir
+        self._values: "OrderedDict[Hashable, Any]" = OrderedDict()
+        # Keys of archives this store rolled over to disk
+        self._rolled: Set[Hashable] = set()
+
+    def get(self, key: Hashable, default: Optional[Any] = None) -> Any:
+        """Return the value for `key`, marking it as recently used."""
+        if key not in self._values:
+            return default
+        self._values.move_to_end(key)
+        return self._values[key]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        """
+        Store `value` as the most recently used entry and enforce the budget.
+
+        Args:
+            key: Entry name
+            value: Image, archive or other value; a replaced archive is closed
+        """
+        self.pop(key)
+        self._values[key] = value
+        self.enforce()
+
+    def pop(self, key: Hashable) -> Any:
+        """Remove and return the value for `key`, closing a replaced archive."""
+        value = self._values.pop(key, None)
+        self._rolled.discard(key)
+        if isinstance(value, SpooledTemporaryFile):
+            value.close()
+        return value
+
+    def usage(self) -> int:
+        """Bytes currently held in memory by the stored values."""
+        return sum(self._memory_usage(key, value) for key, value in self._values.items())
+
+    def _memory_usage(self, key: Hashable, value: Any) -> int:
+        return 0 if key in self._rolled else memory_usage(value)
+
+    def enforce(self) -> None:
+        """Demote least recently used values until usage fits the budget."""
+        usage = self.usage()
+        for key, value in list(self._values.items()):
+            while usage > self.budget and key not in self._rolled:
+                freed = demote(value, self.spill_dir)
+                if isinstance(value, SpooledTemporaryFile):
+                    self._rolled.add(key)
+                if not freed:
+                    break
+                usage -= freed
+            if usage <= self.budget:
+                return
@@ -0,0 +1,268 @@
+import os
+import json
+import math
+import time
+import threading
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional
+
+# Number of recent spans kept in memory for aggregates
+DEFAULT_MAX_SPANS = int(os.environ.get("IMAGE_METRICS_MAX_SPANS", "5000"))
+
+# Optional JSONL file every finished span is appended to
+DEFAULT_METRICS_FILE = os.environ.get("IMAGE_METRICS_FILE")
+
+PERCENTILES = (50, 95, 99)
+
+# Duration fields exported as Prometheus summaries
+SUMMARY_FIELDS = ("api_latency", "queue_wait", "decode_time")
+
+
+class Span:
+    """
+    Timing and size measurements for one image request (or cache lookup).
+
+    Durations are in seconds. `queue_wait` covers time spent waiting for a
+    worker thread, a rate-limit token or a Retry-After pause; `backoff_wait`
+    is time slept between retries; `api_latency` is the successful attempt.
+    A `coalesced` span waited for an identical request already in flight
+    instead of calling the API itself.
+    """
+
+    FIELDS = (
+        "kind", "size", "variants", "cache_hit", "coalesced", "retries", "error",
+        "queue_wait", "backoff_wait", "api_latency", "decode_time", "total",
+        "bytes_sent", "bytes_received", "image_bytes", "images",
+        "started_at", "finished_at",
+    )
+
+    def __init__(self, kind: str, size: str = "auto", variants: int = 1):
+        self.kind = kind
+        self.size = size
+        self.variants = variants
+        self.cache_hit = False
+        self.coalesced = False
+        self.retries = 0
+        self.error: Optional[str] = None
+        self.queue_wait = 0.0
+        self.backoff_wait = 0.0
+        self.api_latency = 0.0
+        self.decode_time = 0.0
+        self.total = 0.0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.image_bytes = 0
+        self.images = 0
+        self.created = time.perf_counter()
+        self.started_at = time.time()
+        self.finished_at: Optional[float] = None
+
+    def elapsed(self) -> float:
+        """Seconds since the span was created."""
+        return time.perf_counter() - self.created
+
+    @contextmanager
+    def timed(self, field: str) -> Iterator[None]:
+        """Add the duration of the `with` block to the duration field `field`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            setattr(self, field, getattr(self, field) + time.perf_counter() - start)
+
+    def finish(self, recorder: Optional["MetricsRecorder"] = None) -> None:
+        """Close the span and hand it to `recorder` (the shared one by default)."""
+        self.total = self.elapsed()
+        self.finished_at = time.time()
+        (recorder or get_metrics()).record(self)
+
+    def to_dict(self) -> Dict[str, object]:
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+
+def record_cache_hit(kind: str, size: str, nbytes: int) -> None:
+    """Record an image served from the result cache without an API call."""
+    span = Span(kind, size=size)
+    span.cache_hit = True
+    span.images = 1
+    span.image_bytes = nbytes
+    span.finish()
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of `values` (0.0 for an empty list)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+class JsonlFileSink:
+    """Appends every finished span to a JSON-lines file."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def __call__(self, span: Span) -> None:
+        line = json.dumps(span.to_dict())
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+
+class MetricsRecorder:
+    """
+    Keeps the most recent spans in memory, computes aggregates and forwards
+    each span to any registered sinks (files, exporters, test probes).
+
+    Aggregates in `summary` cover the recent spans only; the cumulative
+    totals behind the Prometheus counters are kept separately so they never
+    decrease when old spans drop out of the window.
+    """
+
+    def __init__(self, max_spans: int = DEFAULT_MAX_SPANS):
+        self._spans = deque(maxlen=max_spans)
+        self._totals: Dict[str, Dict[str, float]] = {}
+        self._sinks: List[Callable[[Span], None]] = []
+        self._lock = threading.Lock()
+
+    def add_sink(self, sink: Callable[[Span], None]) -> None:
+        """Register a callable that receives every finished span."""
+        with self._lock:
+            self._sinks.append(sink)
+
+    def record(self, span: Span) -> None:
+        with self._lock:
+            self._spans.append(span)
+            totals = self._totals.setdefault(span.kind, defaultdict(float))
+            totals["calls"] += 1
+            totals["cache_hits"] += span.cache_hit
+            totals["coalesced"] += span.coalesced
+            totals["errors"] += span.error is not None
+            totals["retries"] += span.retries
+            totals["images"] += span.images
+            totals["bytes_received"] += span.bytes_received
+            if not span.cache_hit and not span.coalesced and span.error is None:
+                for field in SUMMARY_FIELDS:
+                    totals[f"{field}_sum"] += getattr(span, field)
+                    totals[f"{field}_count"] += 1
+            sinks = list(self._sinks)
+        for sink in sinks:
+            try:
+                sink(span)
+            except Exception:
+                # Metrics must never break image generation
+                pass
+
+    def spans(self, kind: Optional[str] = None) -> List[Span]:
+        with self._lock:
+            spans = list(self._spans)
+        return [span for span in spans if kind is None or span.kind == kind]
+
+    def clear(self) -> None:
+        """Forget the recent spans; cumulative totals are kept."""
+        with self._lock:
+            self._spans.clear()
+
+    def totals(self, kind: str) -> Dict[str, float]:
+        """Cumulative counters for `kind` since the recorder was created."""
+        with self._lock:
+            return dict(self._totals.get(kind, {}))
+
+    def summary(self, kind: Optional[str] = None) -> Dict[str, float]:
+        """
+        Aggregates over the recorded spans: call counts, cache hit rate,
+        latency percentiles and image throughput.
+
+        Args:
+            kind: Restrict to one generator ("icon"/"diagram"); None for all
+        """
+        spans = self.spans(kind)
+        api_spans = [span for span in spans
+                     if not span.cache_hit and not span.coalesced and span.error is None]
+        stats: Dict[str, float] = {
+            "calls": len(spans),
+            "cache_hits": sum(1 for span in spans if span.cache_hit),
+            "coalesced": sum(1 for span in spans if span.coalesced),
+            "errors": sum(1 for span in spans if span.error is not None),
+            "retries": sum(span.retries for span in spans),
+            "images": sum(span.images for span in spans),
+            "bytes_received": sum(span.bytes_received for span in spans),
+        }
+        stats["cache_hit_rate"] = stats["cache_hits"] / len(spans) if spans else 0.0
+        for field in ("api_latency", "queue_wait", "decode_time", "total"):
+            values = [getattr(span, field) for span in api_spans]
+            for pct in PERCENTILES:
+                stats[f"{field}_p{pct}"] = percentile(values, pct)
+        if spans:
+            window = max(span.finished_at for span in spans) - min(span.started_at for span in spans)
+            stats["images_per_second"] = stats["images"] / window if window > 0 else 0.0
+        else:
+            stats["images_per_second"] = 0.0
+        return stats
+
+    def to_prometheus(self) -> str:
+        """Render the current aggregates in the Prometheus text exposition format."""
+        lines = []
+
+        def metric(name: str, metric_type: str, help_text: str, samples: List[str]) -> None:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            lines.extend(samples)
+
+        with self._lock:
+            kinds = sorted(self._totals)
+        totals = {kind: self.totals(kind) for kind in kinds}
+
+        # Quantiles cover the recent spans; _sum and _count are cumulative
+        for field, help_text in zip(SUMMARY_FIELDS, (
+            "Image API latency of successful calls",
+            "Time spent waiting for a worker or rate-limit token",
+            "Time spent decoding base64 payloads",
+        )):
+            name = f"image_{field}_seconds"
+            samples = []
+            for kind in kinds:
+                values = [getattr(span, field) for span in self.spans(kind)
+                          if not span.cache_hit and not span.coalesced and span.error is None]
+                for pct in PERCENTILES:
+                    samples.append(
+                        f'{name}{{kind="{kind}",quantile="{pct / 100}"}} {percentile(values, pct)}')
+                samples.append(f'{name}_sum{{kind="{kind}"}} {totals[kind].get(f"{field}_sum", 0.0)}')
+                samples.append(f'{name}_count{{kind="{kind}"}} {int(totals[kind].get(f"{field}_count", 0))}')
+            metric(name, "summary", help_text, samples)
+
+        for key, name, help_text in (
+            ("calls", "image_requests_total", "Image requests including cache hits"),
+            ("cache_hits", "image_cache_hits_total", "Requests served from the result cache"),
+            ("coalesced", "image_coalesced_requests_total", "Requests shared with an identical in-flight call"),
+            ("errors", "image_request_errors_total", "Requests that failed after retries"),
+            ("retries", "image_request_retries_total", "Retried API attempts"),
+            ("images", "image_generated_images_total", "Images produced"),
+            ("bytes_received", "image_bytes_received_total", "Base64 payload bytes received"),
+        ):
+            metric(name, "counter", help_text,
+                   [f'{name}{{kind="{kind}"}} {int(totals[kind].get(key, 0))}' for kind in kinds])
+
+        return "\n".join(lines) + "\n"
+
+    def export_jsonl(self) -> str:
+        """All recorded spans as JSON lines."""
+        return "".join(json.dumps(span.to_dict()) + "\n" for span in self.spans())
+
+
+_metrics: Optional[MetricsRecorder] = None
+_metrics_lock = threading.Lock()
+
+
+def get_metrics() -> MetricsRecorder:
+    """Return the process-wide metrics recorder, creating it on first use."""
+    global _metrics
+    with _metrics_lock:
+        if _metrics is None:
+            _metrics = MetricsRecorder()
+            if DEFAULT_METRICS_FILE:
+                _metrics.add_sink(JsonlFileSink(DEFAULT_METRICS_FILE))
+        return _metrics
@@ -0,0 +1,283 @@
+import os
+import queue
+import threading
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from io import BytesIO
+from typing import Any, Iterable, Iterator, List, Optional, Tuple
+import numpy as np
+from PIL import Image
+
+# Card colour the icon system prompt asks for
+CARD_COLOR = (0xf9, 0xf1, 0xdd)
+
+# Side length of the square canvas every processed icon is fitted onto
+DEFAULT_ICON_SIZE = 1024
+
+# Transparent margin around the trimmed icon, as a fraction of the canvas
+DEFAULT_MARGIN = 0.04
+
+# Largest per-channel difference from the border colour that counts as background
+DEFAULT_BACKGROUND_TOLERANCE = 24
+
+# Largest per-channel difference from CARD_COLOR that counts as card surface
+DEFAULT_CARD_TOLERANCE = 48
+
+# Minimum share of border pixels that must match for the background to be keyed out
+MIN_UNIFORM_BORDER = 0.9
+
+# Number of worker processes for batches (defaults to the CPU count)
+DEFAULT_POSTPROCESS_WORKERS = int(os.environ.get("IMAGE_POSTPROCESS_WORKERS", "0")) or None
+
+
+def _spread_along_rows(mask: np.ndarray, reached: np.ndarray) -> np.ndarray:
+    """Extend `reached` to every horizontal run of `mask` it touches."""
+    starts = mask.copy()
+    starts[:, 1:] &= ~mask[:, :-1]
+    runs = np.cumsum(starts.ravel()).reshape(mask.shape) * mask
+    touched = np.bincount(runs[reached & mask], minlength=runs.max() + 1) > 0
+    touched[0] = False
+    return touched[runs]
+
+
+def flood_from_border(mask: np.ndarray) -> np.ndarray:
+    """
+    Pixels of `mask` connected to the image border (4-connectivity).
+
+    Alternates whole-row and whole-column run propagation until nothing
+    changes, so the number of passes grows with the number of turns in the
+    background rather than with the image size.
+
+    Args:
+        mask: HxW bool array of candidate pixels
+    """
+    reached = np.zeros_like(mask)
+    reached[[0, -1], :] = mask[[0, -1], :]
+    reached[:, [0, -1]] = mask[:, [0, -1]]
+    while True:
+        spread = _spread_along_rows(mask, reached)
+        spread = _spread_along_rows(mask.T, spread.T).T
+        if np.array_equal(spread, reached):
+            return reached
+        reached = spread
+
+
+def key_out_background(
+    rgba: np.ndarray,
+    tolerance: int = DEFAULT_BACKGROUND_TOLERANCE,
+    card_color: Optional[Tuple[int, int, int]] = CARD_COLOR
+) -> np.ndarray:
+    """
+    Make a near-uniform background transparent.
+
+    The background colour is the median of the border pixels. Pixels within
+    `tolerance` of it that are connected to the border become transparent,
+    with a soft ramp over the next `tolerance` levels so anti-aliased edges
+    keep partial alpha; enclosed areas of the same colour are left alone.
+    When the background is close to `card_color` the tolerance shrinks so the
+    card can never be keyed out. Images whose border is already transparent or
+    not uniform are returned unchanged.
+
+    Args:
+        rgba: HxWx4 uint8 array
+        tolerance: Largest per-channel difference treated as background
+        card_color: Colour that must stay opaque (None for no limit)
+    """
+    border = np.concatenate([rgba[0], rgba[-1], rgba[1:-1, 0], rgba[1:-1, -1]])
+    if np.median(border[:, 3]) < 255:
+        return rgba
+    background = np.median(border[:, :3], axis=0)
+    if card_color is not None:
+        # Keep the whole ramp (2 * tolerance) short of the card colour
+        card_distance = int(np.abs(np.array(card_color) - background).max())
+        tolerance = min(tolerance, (card_distance - 1) // 2)
+        if tolerance < 1:
+            return rgba
+    border_distance = np.abs(border[:, :3].astype(np.int16) - background).max(axis=1)
+    if np.mean(border_distance <= tolerance) < MIN_UNIFORM_BORDER:
+        return rgba
+
+    distance = np.abs(rgba[..., :3].astype(np.int16) - background).max(axis=2)
+    background_mask = flood_from_border(distance < 2 * tolerance)
+    keep = np.clip((distance - tolerance) / tolerance, 0.0, 1.0)
+    out = rgba.copy()
+    out[..., 3] = np.where(background_mask, np.minimum(rgba[..., 3], (keep * 255).astype(np.uint8)), rgba[..., 3])
+    return out
+
+
+def trim(rgba: np.ndarray, threshold: int = 8) -> np.ndarray:
+    """
+    Crop to the bounding box of pixels more opaque than `threshold`.
+
+    Args:
+        rgba: HxWx4 uint8 array
+        threshold: Alpha at or below which a pixel counts as padding
+    """
+    opaque = rgba[..., 3] > threshold
+    rows = np.flatnonzero(opaque.any(axis=1))
+    cols = np.flatnonzero(opaque.any(axis=0))
+    if rows.size == 0:
+        return rgba
+    return rgba[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+
+
+def normalize_card_color(
+    rgba: np.ndarray,
+    color: Tuple[int, int, int] = CARD_COLOR,
+    tolerance: int = DEFAULT_CARD_TOLERANCE
+) -> np.ndarray:
+    """
+    Shift card-coloured pixels so their average is exactly `color`.
+
+    Only opaque pixels within `tolerance` of `color` move, and they all move
+    by the same offset, so the card's shading and the printed artwork are
+    preserved.
+
+    Args:
+        rgba: HxWx4 uint8 array
+        color: Target card colour
+        tolerance: Largest per-channel difference treated as card surface
+    """
+    rgb = rgba[..., :3].astype(np.int16)
+    target = np.array(color, dtype=np.int16)
+    card = (np.abs(rgb - target).max(axis=2) <= tolerance) & (rgba[..., 3] == 255)
+    if not card.any():
+        return rgba
+    offset = np.round(target - rgb[card].mean(axis=0)).astype(np.int16)
+    out = rgba.copy()
+    out[..., :3][card] = np.clip(rgb[card] + offset, 0, 255).astype(np.uint8)
+    return out
+
+
+def fit_to_canvas(rgba: np.ndarray, size: int = DEFAULT_ICON_SIZE, margin: float = DEFAULT_MARGIN) -> Image.Image:
+    """
+    Scale an icon to fit a transparent `size` x `size` canvas, centred.
+
+    Args:
+        rgba: HxWx4 uint8 array
+        size: Canvas side length in pixels
+        margin: Transparent margin on each side, as a fraction of `size`
+    """
+    img = Image.fromarray(rgba, "RGBA")
+    inner = max(1, round(size * (1 - 2 * margin)))
+    scale = inner / max(img.width, img.height)
+    img = img.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))), Image.LANCZOS)
+    canvas = Image.new("RGBA", (size, size), (0, 0, 0, 0))
+    canvas.paste(img, ((size - img.width) // 2, (size - img.height) // 2))
+    return canvas
+
+
+def postprocess_icon(
+    data: bytes,
+    size: int = DEFAULT_ICON_SIZE,
+    card_color: Optional[Tuple[int, int, int]] = CARD_COLOR
+) -> bytes:
+    """
+    Clean up a generated icon: transparent background, trimmed padding,
+    normalised card colour and a consistent square size.
+
+    Args:
+        data: Encoded icon image
+        size: Side length of the output PNG
+        card_color: Colour to normalise the card to (None to leave it)
+    """
+    rgba = np.asarray(Image.open(BytesIO(data)).convert("RGBA"))
+    rgba = trim(key_out_background(rgba, card_color=card_color))
+    if card_color is not None:
+        rgba = normalize_card_color(rgba, card_color)
+    buf = BytesIO()
+    fit_to_canvas(rgba, size).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def postprocess_icons(
+    images: Iterable[Tuple[bytes, Any]],
+    **options: Any
+) -> Iterator[Tuple[bytes, Any]]:
+    """
+    Post-process a stream of icons in the shared process pool.
+
+    A feeder thread pulls `images` and submits each one as it arrives, and
+    results are yielded in completion order as soon as they are ready, so a
+    generator of API results can be piped straight through. An image that
+    fails to process is yielded unchanged; an error raised by `images` is
+    re-raised here.
+
+    The feeder owns `images`: it closes it (if it has a `close` method) once
+    the stream ends or the returned generator is closed, so callers must not
+    close it themselves. Closing the returned generator does not wait for the
+    item being pulled; the feeder drops it and stops as soon as it arrives.
+
+    Args:
+        images: (encoded image, tag) pairs; the tag is passed through
+        **options: Keyword arguments for `postprocess_icon`
+    """
+    pool = get_postprocess_pool()
+    ready: "queue.Queue[Tuple[Optional[Future], Any, Any]]" = queue.Queue()
+    submitted: List[Future] = []
+    stop = threading.Event()
+
+    def feed() -> None:
+        try:
+            for data, tag in images:
+                if stop.is_set():
+                    break
+                future = pool.submit(postprocess_icon, data, **options)
+                future.add_done_callback(lambda f, data=data, tag=tag: ready.put((f, data, tag)))
+                submitted.append(future)
+        except BaseException as e:
+            ready.put((None, len(submitted), e))
+        else:
+            ready.put((None, len(submitted), None))
+        finally:
+            close = getattr(images, "close", None)
+            if close is not None:
+                close()
+            if stop.is_set():
+                cancel_all()
+
+    def cancel_all() -> None:
+        for future in list(submitted):
+            future.cancel()
+
+    feeder = threading.Thread(target=feed, name="postprocess-feed", daemon=True)
+    feeder.start()
+    total: Optional[int] = None
+    finished = 0
+    try:
+        while total is None or finished < total:
+            future, data, tag = ready.get()
+            if future is None:
+                # The feeder is done: `data` is the number of submitted images
+                if tag is not None:
+                    raise tag
+                total = data
+                continue
+            finished += 1
+            try:
+                processed = future.result()
+            except Exception:
+                processed = data
+            yield processed, tag
+    finally:
+        # Drop queued work if the caller stops consuming early; the feeder
+        # stops (and closes `images`) in the background
+        stop.set()
+        cancel_all()
+
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def get_postprocess_pool() -> ProcessPoolExecutor:
+    """Return the process-wide post-processing pool, creating it on first use."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # Spawned workers: forking a server full of threads is unsafe
+            _pool = ProcessPoolExecutor(
+                max_workers=DEFAULT_POSTPROCESS_WORKERS,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return _pool
@@ -0,0 +1,203 @@
+import os
+import time
+import random
+import threading
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable, List, Optional, Sequence, TypeVar
+import openai
+from metrics_utils import Span
+
+T = TypeVar("T")
+
+# Defaults for the shared scheduler (overridable via environment)
+DEFAULT_REQUESTS_PER_MINUTE = float(os.environ.get("IMAGE_API_RPM", "50"))
+DEFAULT_MAX_RETRIES = int(os.environ.get("IMAGE_API_MAX_RETRIES", "5"))
+
+# HTTP statuses worth retrying: timeouts, conflicts, rate limits and server errors
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+# Largest `n` the images endpoints accept in one request
+MAX_IMAGES_PER_REQUEST = 10
+
+
+def is_retryable(exc: Exception) -> bool:
+    """Whether an API error is transient and the request should be retried."""
+    if isinstance(exc, (openai.APIConnectionError, openai.APITimeoutError)):
+        return True
+    if isinstance(exc, openai.APIStatusError):
+        return exc.status_code in RETRYABLE_STATUS_CODES
+    return False
+
+
+def split_into_batches(
+    slots: Sequence[int],
+    max_per_request: int = MAX_IMAGES_PER_REQUEST
+) -> List[List[int]]:
+    """
+    Split variant slots into the fewest requests the API allows, as evenly as
+    possible (e.g. 12 slots -> 6 + 6 rather than 10 + 2).
+
+    Args:
+        slots: Variant indices still to generate
+        max_per_request: Maximum images per request
+    """
+    if not slots:
+        return []
+    batch_count = -(-len(slots) // max_per_request)
+    batch_size = -(-len(slots) // batch_count)
+    return [list(slots[i:i + batch_size]) for i in range(0, len(slots), batch_size)]
+
+
+def retry_after_seconds(exc: Exception) -> Optional[float]:
+    """Delay requested by the server via Retry-After / retry-after-ms, if any."""
+    response = getattr(exc, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get("retry-after")
+    if not retry_after:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
+    # Retry-After may also be an HTTP date
+    try:
+        return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket limiting how many requests start per minute.
+
+    The bucket holds up to `capacity` tokens (defaults to one second's worth of
+    requests, at least one) and refills continuously at `requests_per_minute`.
+    """
+
+    def __init__(self, requests_per_minute: float, capacity: Optional[float] = None):
+        self.rate = requests_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else max(1.0, self.rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """Block until a token is available. Returns the time spent waiting."""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class RequestScheduler:
+    """
+    Runs image API calls under a shared requests-per-minute limit, retrying
+    transient failures with jittered exponential backoff.
+
+    A 429 with Retry-After pauses every caller of the scheduler, not just the
+    request that hit it, since the limit is shared across the organisation.
+    Server-requested waits longer than `max_delay` are not honoured: the
+    request fails instead, so one bad header cannot stall the whole process.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: float = DEFAULT_REQUESTS_PER_MINUTE,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0
+    ):
+        self.bucket = TokenBucket(requests_per_minute)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _backoff(self, attempt: int) -> float:
+        # "Full jitter": a random delay up to the exponential cap
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def _wait_for_pause(self) -> float:
+        with self._lock:
+            remaining = self._paused_until - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+            return remaining
+        return 0.0
+
+    def call(
+        self,
+        fn: Callable[..., T],
+        *args: Any,
+        span: Optional[Span] = None,
+        **kwargs: Any
+    ) -> T:
+        """
+        Call `fn(*args, **kwargs)` once a rate-limit token is available,
+        retrying transient API errors up to `max_retries` times.
+
+        Args:
+            span: Optional metrics span receiving queue wait, backoff, latency
+                and retry count
+
+        Raises:
+            The last error if it is not retryable, retries are exhausted or
+            the server asks to wait longer than `max_delay`
+        """
+        span = span or Span("untracked")
+        attempt = 0
+        while True:
+            span.queue_wait += self._wait_for_pause()
+            span.queue_wait += self.bucket.acquire()
+            start = time.perf_counter()
+            try:
+                result = fn(*args, **kwargs)
+                span.api_latency = time.perf_counter() - start
+                return result
+            except Exception as e:
+                if not is_retryable(e) or attempt >= self.max_retries:
+                    raise
+                delay = retry_after_seconds(e)
+                if delay is None:
+                    delay = self._backoff(attempt)
+                elif delay > self.max_delay:
+                    raise
+                elif getattr(e, "status_code", None) == 429:
+                    with self._lock:
+                        self._paused_until = max(
+                            self._paused_until, time.monotonic() + delay)
+                attempt += 1
+                span.retries = attempt
+                span.backoff_wait += delay
+                time.sleep(delay)
+
+
+_scheduler: Optional[RequestScheduler] = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> RequestScheduler:
+    """Return the process-wide scheduler shared by all generators."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = RequestScheduler()
+        return _scheduler
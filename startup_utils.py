@@ -0,0 +1,42 @@
+import os
+import sys
+import json
+import subprocess
+from typing import Any, Dict
+
+# Heavy modules the login page must not import; they load after sign-in
+DEFERRED_MODULES = ("openai", "httpx", "PIL", "numpy")
+
+# Runs app.py up to the login page and reports how long that took
+STARTUP_PROBE = """
+import sys, json, time
+start = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+at = AppTest.from_file(sys.argv[1], default_timeout=60)
+at.run()
+print(json.dumps({
+    "seconds": time.perf_counter() - start,
+    "loaded": [name for name in sys.argv[2:] if name in sys.modules],
+    "errors": [str(e.value) for e in at.exception],
+}))
+"""
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def probe_startup(app_dir: str = APP_DIR) -> Dict[str, Any]:
+    """
+    Render the login page once in a fresh interpreter.
+
+    Args:
+        app_dir: Directory containing app.py
+
+    Returns:
+        `seconds` taken, the DEFERRED_MODULES that were `loaded` and any
+        `errors` the page raised
+    """
+    output = subprocess.run(
+        [sys.executable, "-c", STARTUP_PROBE, os.path.join(app_dir, "app.py"), *DEFERRED_MODULES],
+        cwd=app_dir, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
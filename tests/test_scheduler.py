@@ -0,0 +1,68 @@
+"""Retry and Retry-After handling against the benchmark's mock images API."""
+import time
+import pytest
+
+pytest.importorskip("openai")
+
+import cache_utils
+import client_utils
+import scheduler_utils
+from benchmark import MockImagesServer
+from icon_utils import generate_icons
+
+# Longest Retry-After the scheduler under test honours
+MAX_DELAY = 1.0
+
+
+@pytest.fixture
+def run_icons(tmp_path, monkeypatch):
+    """Run `generate_icons` against a mock server; returns (yielded prompts, failed prompts, server)."""
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    monkeypatch.setattr(cache_utils, "_cache", cache_utils.ImageCache(str(tmp_path)))
+    monkeypatch.setattr(scheduler_utils, "_scheduler", scheduler_utils.RequestScheduler(
+        requests_per_minute=1_000_000, base_delay=0.01, max_delay=MAX_DELAY))
+
+    def run(prompts, scripted_errors):
+        with MockImagesServer(latency=0.0, payload_size="16x16", scripted_errors=scripted_errors) as server:
+            client_utils.set_client(client_utils.create_client(base_url=server.base_url))
+            try:
+                failed = []
+                yielded = [prompt for _, prompt in generate_icons(
+                    prompts, use_cache=False, on_error=lambda prompt, e: failed.append(prompt))]
+            finally:
+                client_utils.set_client(None)
+        return yielded, failed, server
+
+    return run
+
+
+def test_rate_limit_retry_after_is_honoured(run_icons):
+    start = time.perf_counter()
+    yielded, failed, server = run_icons(["rate limited"], {"rate limited": [(429, 0.3)]})
+    assert yielded == ["rate limited"]
+    assert failed == []
+    assert server.attempts["rate limited"] == 2
+    assert time.perf_counter() - start >= 0.3
+
+
+def test_server_errors_are_retried(run_icons):
+    yielded, failed, server = run_icons(["flaky"], {"flaky": [(503, None), (500, None)]})
+    assert yielded == ["flaky"]
+    assert server.attempts["flaky"] == 3
+
+
+def test_retry_after_over_max_delay_fails_only_that_prompt(run_icons):
+    start = time.perf_counter()
+    yielded, failed, server = run_icons(
+        ["slow down", "fine"], {"slow down": [(429, MAX_DELAY * 100)]})
+    assert yielded == ["fine"]
+    assert failed == ["slow down"]
+    assert server.attempts["slow down"] == 1
+    assert time.perf_counter() - start < MAX_DELAY
+
+
+def test_bad_request_is_not_retried(run_icons):
+    yielded, failed, server = run_icons(["invalid"], {"invalid": [(400, None)]})
+    assert yielded == []
+    assert failed == ["invalid"]
+    assert server.attempts["invalid"] == 1
@@ -0,0 +1,27 @@
+"""Cold-start checks for the login page, each run in a fresh interpreter."""
+import os
+import pytest
+
+pytest.importorskip("streamlit.testing.v1")
+
+from startup_utils import probe_startup
+
+# Seconds allowed for rendering the login page from a cold interpreter
+STARTUP_BUDGET = float(os.environ.get("STARTUP_BUDGET_SECONDS", "2.0"))
+
+
+@pytest.fixture(scope="module")
+def probe():
+    return probe_startup()
+
+
+def test_login_page_renders(probe):
+    assert probe["errors"] == []
+
+
+def test_login_page_defers_heavy_imports(probe):
+    assert probe["loaded"] == []
+
+
+def test_login_page_within_budget(probe):
+    assert probe["seconds"] <= STARTUP_BUDGET